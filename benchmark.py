@@ -0,0 +1,665 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# (c) 2021 Arnim Eijkhoudt (arnime <thingamajic> kpn-cert.nl), GPLv3
+#
+# Please note: the MITRE ATT&CK® framework is a registered trademark
+# of MITRE. See https://attack.mitre.org/ for more information.
+#
+
+'''
+Benchmark harness for AttackMatrix: generates synthetic STIX bundles shaped
+like the matrices in config/matrixtable.py (at a scalable multiple of the
+size of ATT&CK), then times building, saving and loading the cache, every
+query type, the latency of the API endpoints through an in-process ASGI
+client, and the cold start of a fresh interpreter: the time to import the
+engine and the API, and to answer a first query from a prebuilt cache (the
+target for which is below 100ms, including starting Python). The results are
+written to a JSON file, and two such files can be compared to spot
+regressions between commits. Downloading the matrices is checked against a
+local stand-in server, including resuming interrupted transfers. The load
+test instead measures the throughput of the overlap endpoints against a
+server with a growing number of --workers.
+'''
+
+import argparse
+import asyncio
+import functools
+import gc
+import hashlib
+import http.client
+import http.server
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+import attackmatrix
+import matrixapi
+import matrixengine
+from config.matrixtable import Matrices
+
+
+# Approximate number of objects per matrix in ATT&CK (at scale 1), and the
+# MITRE ID prefix of every type
+shapes = {
+    'Enterprise': {
+        'intrusion-set': 135, 'campaign': 20, 'malware': 550, 'tool': 80,
+        'course-of-action': 45, 'attack-pattern': 600, 'x-mitre-tactic': 14,
+    },
+    'ICS': {
+        'intrusion-set': 12, 'malware': 20, 'course-of-action': 50,
+        'attack-pattern': 80, 'x-mitre-tactic': 12,
+    },
+    'PRE': {
+        'intrusion-set': 5, 'attack-pattern': 170, 'x-mitre-tactic': 15,
+    },
+    'Mobile': {
+        'intrusion-set': 10, 'malware': 90, 'tool': 3, 'course-of-action': 12,
+        'attack-pattern': 70, 'x-mitre-tactic': 14,
+    },
+}
+prefixes = {
+    'intrusion-set': 'G',
+    'campaign': 'C',
+    'malware': 'S',
+    'tool': 'S',
+    'course-of-action': 'M',
+    'attack-pattern': 'T',
+    'x-mitre-tactic': 'TA',
+}
+
+
+def generateBundles(directory, scale=1, seed=0):
+    '''
+    Write one synthetic STIX bundle per matrix into directory. Actors are
+    shared between matrices (with a different STIX id but the same MITRE ID,
+    as in ATT&CK), so merging is exercised as well.
+    '''
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for i in range(rng.randint(3, 10)))
+                  for word in range(5000)]
+    def text(words):
+        return ' '.join(rng.choice(vocabulary) for word in range(words))
+    def stixid(type):
+        return type + '--' + str(uuid.UUID(int=rng.getrandbits(128)))
+    counters = {}
+    for matrix in Matrices:
+        objects = []
+        uids = {}
+        for type, count in shapes[matrix].items():
+            uids[type] = []
+            for number in range(max(1, int(count * scale))):
+                prefix = prefixes[type]
+                if type == 'intrusion-set':
+                    mitreid = 'G%04d' % (number + 1)
+                else:
+                    counters[prefix] = counters.get(prefix, 0) + 1
+                    mitreid = '%s%04d' % (prefix, counters[prefix])
+                object = {
+                    'type': type,
+                    'id': stixid(type),
+                    'name': text(2).title(),
+                    'description': text(rng.randint(20, 150)),
+                    'modified': '2022-10-21T00:00:00.000Z',
+                    'external_references': [{
+                        'source_name': 'mitre-attack',
+                        'external_id': mitreid,
+                        'url': 'https://attack.mitre.org/' + mitreid,
+                    }],
+                }
+                if type == 'intrusion-set':
+                    object['aliases'] = [object['name'], text(1).title(), text(2).title()]
+                elif type == 'x-mitre-tactic':
+                    object['x_mitre_shortname'] = 'phase-%d' % number
+                elif type == 'attack-pattern':
+                    tactics = max(1, int(shapes[matrix]['x-mitre-tactic'] * scale))
+                    object['kill_chain_phases'] = [{'kill_chain_name': 'mitre-%s-attack' % matrix.lower(),
+                                                    'phase_name': 'phase-%d' % tactic}
+                                                   for tactic in rng.sample(range(tactics), min(tactics, 2))]
+                if rng.random() < 0.02:
+                    object['revoked'] = True
+                uids[type].append(object['id'])
+                objects.append(object)
+        relationships = []
+        for actor in uids['intrusion-set'] + uids.get('campaign', []):
+            for type, maximum in (('attack-pattern', 60), ('malware', 8), ('tool', 8)):
+                if uids.get(type):
+                    for target in rng.sample(uids[type], min(len(uids[type]), rng.randint(1, maximum))):
+                        relationships.append((actor, target))
+        for software in uids.get('malware', []) + uids.get('tool', []):
+            for target in rng.sample(uids['attack-pattern'], min(len(uids['attack-pattern']), rng.randint(1, 20))):
+                relationships.append((software, target))
+        for mitigation in uids.get('course-of-action', []):
+            for target in rng.sample(uids['attack-pattern'], min(len(uids['attack-pattern']), rng.randint(1, 30))):
+                relationships.append((mitigation, target))
+        for source, target in relationships:
+            objects.append({
+                'type': 'relationship',
+                'id': stixid('relationship'),
+                'relationship_type': 'uses',
+                'source_ref': source,
+                'target_ref': target,
+                'modified': '2022-10-21T00:00:00.000Z',
+            })
+        rng.shuffle(objects)
+        with open(pathlib.Path(directory) / Matrices[matrix]['file'], 'w') as f:
+            json.dump({'type': 'bundle', 'id': stixid('bundle'), 'spec_version': '2.0', 'objects': objects}, f)
+
+
+def timed(function, repeat=1):
+    '''
+    Call function repeat times, returning its last result and the timings
+    '''
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, timings
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        'n': len(timings),
+        'mean': statistics.mean(timings),
+        'p50': timings[len(timings) // 2],
+        'p99': timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+        'max': timings[-1],
+    }
+
+
+async def asgiGet(app, path, query=''):
+    '''
+    Minimal in-process ASGI client: perform a GET request on app and return
+    the status code and the complete body
+    '''
+    request = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    response = {'status': None, 'body': b''}
+    async def receive():
+        if request:
+            return request.pop()
+        # Never disconnect: streaming responses listen for this
+        await asyncio.Event().wait()
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            response['body'] += message.get('body', b'')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode('utf-8'),
+        'query_string': query.encode('utf-8'),
+        'root_path': '',
+        'headers': [(b'host', b'benchmark')],
+        'client': ('127.0.0.1', 0),
+        'server': ('benchmark', 80),
+    }
+    await app(scope, receive, send)
+    return response['status'], response['body']
+
+
+def benchmarkAPI(requests, repeat):
+    '''
+    Time every (path, query parameters) request through the FastAPI app. The
+    response cache is cleared before every request, so this measures the
+    actual work instead of cache hits.
+    '''
+    results = {}
+    async def run():
+        for name, path, params in requests:
+            query = urllib.parse.urlencode(params, doseq=True)
+            timings = []
+            for i in range(repeat):
+                matrixapi.responsecache.entries.clear()
+                matrixapi.responsecache.bytes = 0
+                start = time.perf_counter()
+                status, body = await asgiGet(matrixapi.app, path, query)
+                timings.append(time.perf_counter() - start)
+                if status != 200:
+                    raise RuntimeError('%s returned HTTP %s' % (path, status))
+            results['api.' + name] = summarize(timings)
+    asyncio.run(run())
+    return results
+
+
+def benchmarkContention(actors, heavy, repeat, slowdown=20):
+    '''
+    Time cheap /api/explore lookups of single actors, first on their own and
+    then while *heavy* requests for a complete category (each with another
+    limit, so they all miss the response cache) are being handled. The heavy
+    requests run in the query executor, so the lookups should hardly slow
+    down; the heavy requests beyond its limits are refused with a 429. Fails
+    if no heavy request was running while the lookups were timed, or if the
+    p99 of the lookups under load is more than *slowdown* times that of the
+    idle lookups (or of the interpreter's thread switch interval, the time a
+    lookup may have to wait for a running query to hand over the GIL). Like
+    serveWorkers(), the loaded cache is frozen out of reach of the garbage
+    collector while the lookups are timed.
+    '''
+    results = {}
+    async def lookups():
+        timings = []
+        for i in range(repeat):
+            matrixapi.responsecache.entries.clear()
+            matrixapi.responsecache.bytes = 0
+            start = time.perf_counter()
+            status, body = await asgiGet(matrixapi.app, '/api/explore/Actors/' + actors[i % len(actors)])
+            timings.append(time.perf_counter() - start)
+            if status != 200:
+                raise RuntimeError('/api/explore returned HTTP %s' % status)
+            await asyncio.sleep(0.005)
+        return timings
+    async def run():
+        results['contention.idle'] = summarize(await lookups())
+        requests = asyncio.gather(*[asgiGet(matrixapi.app, '/api/explore/Techniques', 'limit=%d' % (1000000 + i))
+                                    for i in range(heavy)])
+        await asyncio.sleep(0.01)
+        running = matrixapi.executor.pending
+        results['contention.loaded'] = summarize(await lookups())
+        statuses = [status for status, body in await requests]
+        results['contention.heavy'] = {str(status): statuses.count(status) for status in sorted(set(statuses))}
+        if not running or 200 not in statuses:
+            raise RuntimeError('No heavy request was running while the lookups were timed')
+    gc.collect()
+    gc.freeze()
+    try:
+        asyncio.run(run())
+    finally:
+        gc.unfreeze()
+    if results['contention.loaded']['p99'] > slowdown * max(results['contention.idle']['p99'], sys.getswitchinterval()):
+        raise RuntimeError('Lookups slowed down from %.6fs to %.6fs (p99) while heavy requests were running' %
+                           (results['contention.idle']['p99'], results['contention.loaded']['p99']))
+    return results
+
+
+def benchmarkStartup(cachefile, actors, repeat):
+    '''
+    Time the cold start of fresh interpreters: starting Python, importing the
+    engine, the module and the API, and answering a first actor overlap from
+    the prebuilt *cachefile* with the engine alone. Every script is timed
+    from within (after the interpreter has started) and as the whole process.
+    '''
+    firstquery = (
+        'import matrixengine, types\n'
+        'options = types.SimpleNamespace(cachefile=%r, verbose=False)\n'
+        'result = matrixengine.findActorOverlap(options, %r)\n'
+        'assert result and \'name\' not in result, result' % (str(cachefile), actors)
+    )
+    scripts = {
+        'python': 'pass',
+        'import.engine': 'import matrixengine',
+        'import.attackmatrix': 'import attackmatrix',
+        'import.api': 'import matrixapi',
+        'firstquery': firstquery,
+    }
+    results = {}
+    for name, script in scripts.items():
+        timings, processtimings = [], []
+        for i in range(repeat):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, '-c', 'import time\nstart = time.perf_counter()\n' + script +
+                                      '\nprint(time.perf_counter() - start)'],
+                                     cwd=pathlib.Path(__file__).parent, capture_output=True, text=True)
+            processtimings.append(time.perf_counter() - start)
+            if process.returncode != 0:
+                raise RuntimeError('Startup script %s failed: %s' % (name, process.stderr.strip()))
+            timings.append(float(process.stdout))
+        results['startup.' + name] = summarize(timings)
+        results['startup.' + name + '.process'] = summarize(processtimings)
+    return results
+
+
+class BundleHandler(http.server.SimpleHTTPRequestHandler):
+    '''
+    Local stand-in for the server the matrices are downloaded from: serves the
+    bundles in its directory with an ETag, and honours If-None-Match, Range
+    and If-Range. While truncate is set, every response is cut off after that
+    many bytes, as if the connection dropped.
+    '''
+    truncate = None
+
+    def do_GET(self):
+        path = pathlib.Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404)
+            return
+        data = path.read_bytes()
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range', etag) == etag:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        if self.truncate is None:
+            self.wfile.write(data[start:])
+        else:
+            self.wfile.write(data[start:start + self.truncate])
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmarkDownloads(directory):
+    '''
+    Download the bundles in directory from a local BundleHandler server: first
+    with every transfer interrupted, which must leave resumable .part files
+    behind, then resuming those, then again, which must find every matrix
+    unchanged. Raises a RuntimeError if any of that does not happen.
+    '''
+    results = {}
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(BundleHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    matrices = {matrix: dict(Matrices[matrix], url='http://127.0.0.1:%d/%s' % (server.server_port,
+                                                                              Matrices[matrix]['file']))
+                for matrix in Matrices}
+    with tempfile.TemporaryDirectory() as cachedir:
+        downloadoptions = argparse.Namespace(cachedir=cachedir, force=False, update=True)
+        try:
+            BundleHandler.truncate = 1000
+            if matrixengine.DownloadMatrices(downloadoptions, matrices):
+                raise RuntimeError('An interrupted download was reported as complete')
+            BundleHandler.truncate = None
+            for matrix in matrices.values():
+                if not (pathlib.Path(cachedir) / (matrix['file'] + '.part')).exists():
+                    raise RuntimeError('An interrupted download of %s left no .part file' % matrix['file'])
+            changed, timings = timed(lambda: matrixengine.DownloadMatrices(downloadoptions, matrices))
+            results['download.resume'] = timings[0]
+            for matrix in matrices.values():
+                if ((pathlib.Path(cachedir) / matrix['file']).read_bytes() !=
+                        (pathlib.Path(directory) / matrix['file']).read_bytes()):
+                    raise RuntimeError('The resumed download of %s differs from the original' % matrix['file'])
+            changed, timings = timed(lambda: matrixengine.DownloadMatrices(downloadoptions, matrices))
+            results['download.unchanged'] = timings[0]
+            if changed:
+                raise RuntimeError('Unchanged matrices were downloaded again')
+        finally:
+            BundleHandler.truncate = None
+            server.shutdown()
+            server.server_close()
+    return results
+
+
+def runBenchmarks(options):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        benchoptions = argparse.Namespace(
+            cachedir=directory,
+            cachefile=directory + '/cache.json',
+            cacheformat='json',
+            verbose=False,
+            force=False,
+            token=None,
+            ip='127.0.0.1',
+            port=8008,
+            concurrency=2,
+            queuedepth=8,
+            timeout=60,
+        )
+        _, timings = timed(lambda: generateBundles(directory, options.scale, options.seed))
+        results['generatebundles'] = timings[0]
+        results.update(benchmarkDownloads(directory))
+        cache, timings = timed(lambda: matrixengine.GenerateMatrix(benchoptions))
+        results['generatematrix'] = timings[0]
+        results['generatematrix.peakrss'] = matrixengine.buildstats.get('peakrss')
+        for format in ('json', 'binary'):
+            benchoptions.cacheformat = format
+            benchoptions.cachefile = directory + '/cache.' + format
+            _, timings = timed(lambda: matrixengine.saveCache(benchoptions, cache))
+            results['savecache.' + format] = timings[0]
+            results['cachesize.' + format] = pathlib.Path(benchoptions.cachefile).stat().st_size
+            _, timings = timed(lambda: matrixengine.loadCache(benchoptions), options.repeat)
+            results['loadcache.' + format] = summarize(timings)
+        # Query the JSON cache through the process-wide store, like the API does
+        benchoptions.cachefile = directory + '/cache.json'
+        matrixapi.options = benchoptions
+        snapshot = matrixengine.store.get(benchoptions)
+        for name in matrixengine.indexbuilders:
+            _, timings = timed(lambda: matrixengine.indexbuilders[name](snapshot.cache))
+            results['index.' + name] = timings[0]
+        snapshot.warm()
+        rng = random.Random(options.seed)
+        actors = list(snapshot.cache.ids['Actors'])
+        pair = rng.sample(actors, 2)
+        techniques = list(snapshot.cache.entity('Actors', pair[0]).edges)
+        ttps = [snapshot.cache.mitreid(number) for number in techniques[:3]]
+        terms = [word for word in snapshot.cache.entity('Techniques', next(iter(snapshot.cache.ids['Techniques'])))
+                 .description[0].split()[:2]]
+        queries = {
+            'search.index': lambda: matrixengine.search(benchoptions, terms, snapshot=snapshot),
+            'search.scan': lambda: matrixengine.search(benchoptions, terms, mode='scan', snapshot=snapshot),
+            'resolve': lambda: matrixengine.resolve(benchoptions, [snapshot.cache.entity('Actors', pair[0]).name[0]],
+                                                    snapshot=snapshot),
+            'heatmap': lambda: matrixengine.coverageHeatmap(benchoptions, pair, snapshot=snapshot),
+            'actoroverlap': lambda: matrixengine.findActorOverlap(benchoptions, pair, snapshot=snapshot),
+            'ttpoverlap': lambda: matrixengine.findTTPOverlap(benchoptions, ttps, snapshot=snapshot),
+            'actorsimilarity.all': lambda: matrixengine.findActorSimilarity(benchoptions, snapshot=snapshot),
+            'explore.actor': lambda: matrixengine.explore(benchoptions, 'Actors/' + pair[0], snapshot=snapshot),
+            'explore.techniques': lambda: matrixengine.explore(benchoptions, 'Techniques', snapshot=snapshot),
+        }
+        for name, query in queries.items():
+            _, timings = timed(query, options.repeat)
+            results['query.' + name] = summarize(timings)
+        results.update(benchmarkAPI([
+            ('explore', '/api/explore/Actors/' + pair[0], {}),
+            ('search', '/api/search', {'params': terms}),
+            ('actoroverlap', '/api/actoroverlap', {'actors': pair}),
+            ('ttpoverlap', '/api/ttpoverlap', {'ttps': ttps}),
+            ('heatmap', '/api/heatmap', {'actors': pair}),
+        ], options.repeat))
+        results.update(benchmarkContention(actors, 16, options.repeat))
+        results.update(benchmarkStartup(directory + '/cache.binary', pair, min(options.repeat, 10)))
+        results['entities'] = sum(len(snapshot.cache.ids[category]) for category in snapshot.cache.ids)
+    return results
+
+
+def hammer(port, actors, ttps, duration, seed):
+    '''
+    Load test client: request random overlaps (which are rarely in the
+    response cache) over one keep-alive connection for duration seconds, and
+    return the latency of every request
+    '''
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    timings = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        if rng.random() < 0.5:
+            path = '/api/actoroverlap?' + urllib.parse.urlencode({'actors': rng.sample(actors, 3)}, doseq=True)
+        else:
+            path = '/api/ttpoverlap?' + urllib.parse.urlencode({'ttps': rng.sample(ttps, 2), 'minimum': 1},
+                                                              doseq=True)
+        start = time.perf_counter()
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        timings.append(time.perf_counter() - start)
+        if response.status != 200:
+            raise RuntimeError('%s returned HTTP %s' % (path, response.status))
+    connection.close()
+    return timings
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def waitForServer(port, server, timeout=60):
+    end = time.time() + timeout
+    while time.time() < end:
+        if server.poll() is not None:
+            raise RuntimeError('The server exited with status %s' % server.returncode)
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/api/status')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('The server did not start within %d seconds' % timeout)
+
+
+def loadTest(options):
+    '''
+    Start attackmatrix.py with 1, 2, 4, ... up to options.workers workers on a
+    synthetic cache, and measure the throughput of the overlap endpoints with
+    two clients per worker. The clients need CPU as well, so the server should
+    get at most half of the cores for the scaling to be meaningful.
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        benchoptions = argparse.Namespace(cachedir=directory, cachefile=directory + '/cache.json',
+                                          cacheformat=options.cacheformat, verbose=False)
+        generateBundles(directory, options.scale, options.seed)
+        cache = matrixengine.GenerateMatrix(benchoptions)
+        matrixengine.saveCache(benchoptions, cache)
+        actors = list(cache.ids['Actors'])
+        ttps = list(cache.ids['Techniques'])
+        workers = 1
+        while workers <= options.workers:
+            port = freePort()
+            server = subprocess.Popen([sys.executable, attackmatrix.__file__, '-d', '--workers', str(workers),
+                                       '-i', '127.0.0.1', '-p', str(port), '-m', directory,
+                                       '-c', benchoptions.cachefile, '-l', directory + '/server.log'],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                waitForServer(port, server)
+                clients = 2 * workers
+                with multiprocessing.Pool(clients) as pool:
+                    timings = pool.starmap(hammer, [(port, actors, ttps, options.duration, options.seed + client)
+                                                    for client in range(clients)])
+            finally:
+                server.terminate()
+                server.wait()
+            timings = [timing for client in timings for timing in client]
+            results['loadtest.%d' % workers] = dict(summarize(timings),
+                                                    throughput=len(timings) / options.duration)
+            workers *= 2
+    return results
+
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=pathlib.Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old, new):
+    '''
+    Print the timings of two result files side by side
+    '''
+    for key in sorted(set(old['results']) | set(new['results'])):
+        before, after = old['results'].get(key), new['results'].get(key)
+        if isinstance(before, dict):
+            before = before.get('p50')
+        if isinstance(after, dict):
+            after = after.get('p50')
+        ratio = '%.2fx' % (after / before) if before and after else ''
+        print('%-40s %14s %14s %8s' % (key, before, after, ratio))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='AttackMatrix benchmark harness.')
+    parser.add_argument('-s', '--scale',
+                        dest='scale',
+                        type=float,
+                        default=1,
+                        help='[optional] Size of the synthetic matrices, as a multiple of the '
+                             'size of ATT&CK (default: 1).')
+    parser.add_argument('-r', '--repeat',
+                        dest='repeat',
+                        type=int,
+                        default=20,
+                        help='[optional] Number of times every query is timed (default: 20).')
+    parser.add_argument('--seed',
+                        dest='seed',
+                        type=int,
+                        default=0,
+                        help='[optional] Seed for generating the synthetic matrices (default: 0).')
+    parser.add_argument('-o', '--output',
+                        dest='output',
+                        default='benchmark.json',
+                        help='[optional] File to write the results to (default: \'benchmark.json\').')
+    parser.add_argument('--load-test',
+                        dest='loadtest',
+                        action='store_true',
+                        default=False,
+                        help='[optional] Run the load test instead of the benchmarks.')
+    parser.add_argument('-w', '--workers',
+                        dest='workers',
+                        type=int,
+                        default=max(1, (os.cpu_count() or 1) // 2),
+                        help='[optional] Maximum number of server workers in the load test '
+                             '(default: half of the cores).')
+    parser.add_argument('-t', '--duration',
+                        dest='duration',
+                        type=float,
+                        default=10,
+                        help='[optional] Duration of every load test run in seconds (default: 10).')
+    parser.add_argument('--cache-format',
+                        dest='cacheformat',
+                        choices=['json', 'binary'],
+                        default='json',
+                        help='[optional] Format of the cache used in the load test (default: json).')
+    parser.add_argument('--compare',
+                        dest='compare',
+                        nargs=2,
+                        metavar=('OLD', 'NEW'),
+                        help='[optional] Compare two result files instead of running the benchmarks.')
+    options = parser.parse_args()
+    if options.compare:
+        with open(options.compare[0]) as old, open(options.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        sys.exit(0)
+    results = {
+        'meta': {
+            'commit': gitCommit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scale': options.scale,
+            'repeat': options.repeat,
+            'seed': options.seed,
+            'cpus': os.cpu_count(),
+        },
+        'results': loadTest(options) if options.loadtest else runBenchmarks(options),
+    }
+    with open(options.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for key, value in results['results'].items():
+        print('%-40s %s' % (key, value.get('p50', value) if isinstance(value, dict) else value))
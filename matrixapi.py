@@ -0,0 +1,904 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# (c) 2021 Arnim Eijkhoudt (arnime <thingamajic> kpn-cert.nl), GPLv3
+#
+# Please note: the MITRE ATT&CK® framework is a registered trademark
+# of MITRE. See https://attack.mitre.org/ for more information.
+#
+# I would like to thank MITRE for the permissive licence under which
+# ATT&CK® is available.
+#
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import gc
+import hashlib
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uvicorn
+from config import settings as options
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from matrixengine import *
+from pydantic import BaseModel
+from typing import List, Optional
+
+
+if os.environ.get('ATTACKMATRIX_OPTIONS'):
+    # The reloading development server imports this module in a new process,
+    # so attackmatrix.py passes the command line options along this way
+    options = argparse.Namespace(**json.loads(os.environ['ATTACKMATRIX_OPTIONS']))
+
+
+tags_metadata = [
+    {
+        'name': 'docs',
+        'description': 'This documentation.',
+    },
+    {
+        'name': 'explore',
+        'description': 'Basic interface for exploring the loaded MITRE ATT&CK® matrices. Returns a raw view of everything '
+                       'under *treepath*, including all empty branches. **WARNING**: Can result in a lot of output!'
+                       '<br /><br />'
+                       'To reduce the output, *fields* limits the entities to the given (dotted) fields, e.g. '
+                       '`Metadata.name`, and *relationships*=false leaves out the related entities. A category can '
+                       'be paged through with *limit*, which returns the *entities* and the *cursor* to pass along '
+                       'for the next page. With *format*=`ndjson`, the output is streamed as one JSON line per entity.'
+                       '<br /><br />'
+                       '[Example query]'
+                       '(http://' + options.ip + ':' + str(options.port) + '/api/explore/Actors/G0005) '
+                       'to display all information about the *Actor G0005*.',
+    },
+    {
+        'name': 'search',
+        'description': 'Does a case-insensitive *LOGICAL AND search for all params fields in all entity names, urls and '
+                       'descriptions, and returns a list of matching entities in all loaded MITRE ATT&CK® matrices. '
+                       'Specifying a *limit* returns only the best matching entities, with their relevance scores in '
+                       '*ranking*. The *mode* `scan` searches without using the prebuilt index, which is slower but '
+                       'can be used to compare the results.'
+                       '<br /><br />'
+                       '[Example query]'
+                       '(http://' + options.ip + ':' + str(options.port) +
+                       '/api/search?params=dragon&params=capture&params=property) '
+                       'to find all entities with the words *dragon*, *capture* and *property* in all ATT&CK matrices.',
+    },
+    {
+        'name': 'resolve',
+        'description': 'Maps free-text *names* (e.g. actor names pasted from a report) to the MITRE IDs of the entities '
+                       'with that name or alias, tolerating differences in case, spacing and punctuation, as well as '
+                       'typos. Returns, for every name, the best matching entities (at most *limit*) with a score '
+                       'between *minimum* and 1, where 1 is an exact match. The *categories* limit the entities that '
+                       'are considered.'
+                       '<br /><br />'
+                       '[Example query]'
+                       '(http://' + options.ip + ':' + str(options.port) +
+                       '/api/resolve?names=Cozy%20Bear&names=APT-29&categories=Actors) '
+                       'to find the *Actors* known as *Cozy Bear* and *APT29*.',
+    },
+    {
+        'name': 'actoroverlap',
+        'description': 'Finds the overlapping TTPs (*Malwares, Mitigations, Techniques, etc.*) for '
+                       'two actors. Returns a list of Actors, a list of matrices they were found in, and *only* the TTPs '
+                       'that overlapped (with their names/descriptions). Finding the TTPs that do not overlap can be '
+                       'relatively trivially done through programmatical means, by pulling the complete Actor records '
+                       'using the `/explore/` API endpoint and comparing the results for every actor with the overlapping '
+                       'TTPs logically (`<Overlapping TTPs> NOT <actor\'s TTPs>`) to find the remaining TTPs per actor.'
+                       '<br /><br />'
+                       '[Example query]'
+                       '(http://' + options.ip + ':' + str(options.port) + '/api/actoroverlap?actors=G0064&actors=G0050)'
+                       ' to find the overlapping TTPs of *Actors G0064* and *G0050*.',
+    },
+    {
+        'name': 'ttpoverlap',
+        'description': 'Finds all actors that have a specific set of TTPs (*Malwares, (Sub)Techniques, Techniques '
+                       'and Tools*). The number of TTPs can be varied, i.e.: 1 ... n fields can be given. Returns '
+                       'the matching Actors with all of their ATT&CK® entity types (including names/descriptions). '
+                       'Specifying a *minimum* returns all actors that have at least that many of the given TTPs.'
+                       '<br /><br />'
+                       '[Example query]'
+                       '(http://' + options.ip + ':' + str(options.port) + '/api/ttpoverlap?ttp=S0002&ttp=S0008&ttp=T1560.001) '
+                       'to find which *Actors* use *Tool S0002*, *Tool S0008* and *Technique T1560.001*.',
+    },
+    {
+        'name': 'actorsimilarity',
+        'description': 'Computes how similar actors are, based on the TTPs (by default: *Malwares, Techniques and '
+                       'Tools*) they have in common. The *metric* can be `jaccard` (shared TTPs divided by all TTPs of '
+                       'both actors) or `overlap` (shared TTPs divided by the TTPs of the actor with the fewest). '
+                       'Given one actor and *top*, returns the *top* most similar actors to that actor. Given several '
+                       'actors (or none, meaning all actors), returns the pairwise similarity matrix of those actors.'
+                       '<br /><br />'
+                       '[Example query]'
+                       '(http://' + options.ip + ':' + str(options.port) + '/api/actorsimilarity?actors=G0064&top=10) '
+                       'to find the ten *Actors* most similar to *Actor G0064*.',
+    },
+    {
+        'name': 'aggregates',
+        'description': 'Statistics that are computed once, when the cache is generated: `/api/aggregates` returns, for '
+                       'every *Technique*, the number of *Actors* using it and of *Mitigations* for it; for every '
+                       '*Tactic*, its *Techniques*, the number of *Actors* using any of them and the number of them '
+                       'that are mitigated; for every *Mitigation*, the number of *Techniques* it mitigates; and '
+                       'the tactic x technique co-occurrence (how many *Actors* use every *Technique* of every '
+                       '*Tactic*). `/api/heatmap` returns the same co-occurrence for just the given *actors* (by '
+                       'default: all actors), optionally limited to some *tactics*, with the fraction of the '
+                       'techniques of every tactic that those actors cover.'
+                       '<br /><br />'
+                       '[Example query]'
+                       '(http://' + options.ip + ':' + str(options.port) + '/api/heatmap?actors=G0064&actors=G0050) '
+                       'to find which *Techniques* of every *Tactic* *Actors G0064* and *G0050* use.',
+    },
+    {
+        'name': 'batch',
+        'description': 'Runs a list of *operations* in one request, all against the same loaded cache, and returns '
+                       'their results in the same order, along with how long each took. Every operation is an object '
+                       'with an *op* (`explore`, `search`, `resolve`, `actoroverlap`, `ttpoverlap`, `actorsimilarity`, '
+                       '`neighborhood`, `path` or `heatmap`) and the parameters of that API endpoint, e.g. `{"op": "ttpoverlap", "ttps": ["S0002", "S0008"]}` '
+                       'or `{"op": "explore", "treepath": "Actors/G0005"}`. With *stream* set, the results are '
+                       'streamed as one JSON line per operation as soon as it has finished.',
+    },
+    {
+        'name': 'graph',
+        'description': 'Traverses the relationships between entities on the server, and returns a list of *nodes* and '
+                       '*edges* that can be rendered directly. `/api/graph/neighborhood` returns everything within '
+                       '*hops* relationships of an *entity*, and `/api/graph/path` returns a shortest path between the '
+                       '*source* and *target* entities. Entities are given as `Category/ID` or just their ID. With '
+                       '*categories*, only entities in those categories are traversed, and at most *limit* nodes are '
+                       'returned.'
+                       '<br /><br />'
+                       '[Example query]'
+                       '(http://' + options.ip + ':' + str(options.port) +
+                       '/api/graph/neighborhood?entity=G0005&hops=2&categories=Techniques&categories=Mitigations) '
+                       'to find the *Techniques* used by *Actor G0005*, and the *Mitigations* for those.',
+    },
+    {
+        'name': 'snapshots',
+        'description': 'Every time the cache is generated or updated, a versioned snapshot of it is stored in the '
+                       'cachedir. `/api/snapshots` lists them, and `/api/diff` compares the *old* and *new* snapshots '
+                       '(given by ID, a unique prefix of one, `latest` or `previous`; by default the two most recent '
+                       'ones): which entities were added, removed, revoked or deprecated, and for every changed '
+                       'entity, what changed, e.g. the *Techniques* added to and removed from an *Actor*.'
+                       '<br /><br />'
+                       '[Example query]'
+                       '(http://' + options.ip + ':' + str(options.port) + '/api/diff?old=previous&new=latest) '
+                       'to find what changed in the latest update.',
+    },
+    {
+        'name': 'metrics',
+        'description': 'Exposes timing histograms of every stage of loading the cache and answering queries, request '
+                       'counters, and the size of the loaded cache in the Prometheus text format. Any request sent '
+                       'with an `X-Profile` header (containing the *token*, if one is configured) is profiled by a '
+                       'sampling profiler. The response then has an `X-Profile-Id` header, and the profile can be '
+                       'downloaded as collapsed stacks (for flamegraph.pl or speedscope) from '
+                       '`/metrics/profiles/{X-Profile-Id}`. With `--workers`, every worker process has its own '
+                       'metrics, profiles and response cache, and a request is answered by whichever worker accepts '
+                       'it: the `attackmatrix_worker_info` gauge tells which worker a scrape came from, and a profile '
+                       'can only be downloaded from the worker that recorded it, so retry until it is found.',
+    },
+    {
+        'name': 'status',
+        'description': 'Shows which generation of the cache is currently loaded in memory, when and how fast it was '
+                       'loaded, and how many entities it contains.',
+    },
+]
+app = FastAPI(title='MITRE ATT&CK Matrix API', openapi_tags=tags_metadata)
+
+
+class ResponseCache:
+    '''
+    LRU cache of serialized API responses, bounded by both the number of
+    responses and their total size in bytes. Keys include the generation of
+    the snapshot a response was computed from, so responses for an outdated
+    cache are never served, and simply age out.
+    '''
+    def __init__(self, maxentries=1024, maxbytes=64 << 20):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.maxbytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= len(self.entries.pop(key))
+            self.entries[key] = body
+            self.bytes += len(body)
+            while len(self.entries) > self.maxentries or self.bytes > self.maxbytes:
+                self.bytes -= len(self.entries.popitem(last=False)[1])
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+responsecache = ResponseCache()
+
+
+async def cachedResponse(request, endpoint, compute, blocking=True, **params):
+    '''
+    Return the JSON response of compute(snapshot) for the current snapshot,
+    from the response cache if possible. The ETag of the response identifies
+    the endpoint, its parameters and the cache generation, so clients that
+    send it back in If-None-Match get a 304 until the cache changes.
+    Responses that are not in the response cache are computed by the query
+    executor, unless computing them is cheap enough not to be *blocking*.
+    '''
+    snapshot = store.get(options)
+    generation = snapshot.generation if snapshot else None
+    key = (endpoint, generation, tuple(sorted(params.items())))
+    etag = '"%s-%s"' % (generation, hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16])
+    ifnonematch = request.headers.get('if-none-match')
+    if ifnonematch:
+        etags = [tag.strip() for tag in ifnonematch.split(',')]
+        if '*' in etags or etag in etags or 'W/' + etag in etags:
+            return Response(status_code=304, headers={'ETag': etag})
+    body = responsecache.get(key)
+    if body is None:
+        if blocking:
+            body = await executor.run(serializedResult, endpoint, compute, snapshot)
+        else:
+            body = serializedResult(endpoint, compute, snapshot)
+        responsecache.put(key, body)
+    return Response(body, media_type='application/json', headers={'ETag': etag})
+
+
+jsonencoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(',', ':'))
+
+
+def encodeJSON(value, depth=3):
+    '''
+    Yield the JSON of value, as JSONResponse renders it, in pieces: the dicts
+    and lists up to *depth* levels deep are encoded item by item, so while a
+    large response is being serialized in the query executor, the encoder
+    never holds the GIL (and with it the event loop) for longer than it takes
+    to encode a single entity.
+    '''
+    if depth and isinstance(value, dict) and all(isinstance(key, str) for key in value):
+        separator = '{'
+        for key, item in value.items():
+            yield separator + jsonencoder.encode(key) + ':'
+            yield from encodeJSON(item, depth - 1)
+            separator = ','
+        yield '}' if separator == ',' else '{}'
+    elif depth and isinstance(value, (list, tuple)):
+        separator = '['
+        for item in value:
+            yield separator
+            yield from encodeJSON(item, depth - 1)
+            separator = ','
+        yield ']' if separator == ',' else '[]'
+    else:
+        yield jsonencoder.encode(value)
+
+
+def serializedResult(endpoint, compute, snapshot):
+    result = compute(snapshot)
+    start = time.perf_counter()
+    body = ''.join(encodeJSON(result)).encode('utf-8')
+    metrics.observe('attackmatrix_serialize_seconds', time.perf_counter() - start, endpoint=endpoint)
+    return body
+
+
+class QueryExecutor:
+    '''
+    Bounded thread pool that runs the blocking and CPU-heavy work of requests,
+    so the event loop stays free to answer other clients while a heavy query
+    runs. At most *concurrency* queries run at the same time, and at most
+    *queuedepth* more wait for their turn: beyond that, requests are refused
+    with a 429. A query taking longer than *timeout* seconds is answered with
+    a 504; its thread cannot be interrupted, so the query keeps counting
+    towards the limits until it has finished. Streamed responses are subject
+    to the same limits (see stream()). The limits are read from the options on
+    first use.
+    '''
+    def __init__(self):
+        self.pool = None
+        self.pending = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def configure(self, options):
+        self.concurrency = getattr(options, 'concurrency', None) or 4
+        self.queuedepth = getattr(options, 'queuedepth', None) or 64
+        self.timeout = getattr(options, 'timeout', None) or 30
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='query')
+
+    def admit(self):
+        with self.lock:
+            if self.pool is None:
+                self.configure(options)
+            if self.pending >= self.concurrency + self.queuedepth:
+                self.rejected += 1
+                raise HTTPException(status_code=429, detail='Too many queries in progress, try again later',
+                                    headers={'Retry-After': '1'})
+            self.pending += 1
+
+    async def run(self, function, *args):
+        '''
+        Run function(*args) in the pool. If the request is being profiled, the
+        profiler samples the pool thread while it runs the function.
+        '''
+        self.admit()
+        future = self.pool.submit(self.call, profiling.get(), function, *args)
+        future.add_done_callback(self.done)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                self.timeouts += 1
+            raise HTTPException(status_code=504, detail='The query took longer than ' + str(self.timeout) +
+                                                        ' seconds')
+
+    def stream(self, lines, media_type, chunksize=64):
+        '''
+        Return a StreamingResponse (see QueryStream) over the lines generated by
+        *lines*. The stream is admitted (or refused with a 429) right away, and
+        counts as one query until the response has ended. Its lines are
+        generated in the pool, *chunksize* at a time. As the response has
+        already started, a stream taking longer than *timeout* seconds ends
+        with an error line instead of a 504.
+        '''
+        self.admit()
+        return QueryStream(self, lines, chunksize, profiling.get(), media_type)
+
+    @staticmethod
+    def call(profiler, function, *args):
+        if profiler is None:
+            return function(*args)
+        profiler.attach()
+        try:
+            return function(*args)
+        finally:
+            profiler.detach()
+
+    def done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+
+class QueryStream(StreamingResponse):
+    '''
+    StreamingResponse whose lines are generated by the query executor. The
+    executor slot the stream was admitted with is given back when the
+    response ends, however it ends, also when the client disconnects before
+    the body has been started (in which case the body's generator never
+    runs). A chunk that is still being generated keeps the slot until it is
+    done.
+    '''
+    def __init__(self, executor, lines, chunksize, profiler, media_type):
+        self.executor = executor
+        self.future = None
+        super().__init__(self.streamLines(lines, chunksize, profiler), media_type=media_type)
+
+    async def streamLines(self, lines, chunksize, profiler):
+        executor = self.executor
+        deadline = time.monotonic() + executor.timeout
+        while True:
+            self.future = executor.pool.submit(executor.call, profiler,
+                                               lambda: list(itertools.islice(lines, chunksize)))
+            try:
+                chunk = await asyncio.wait_for(asyncio.wrap_future(self.future), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                with executor.lock:
+                    executor.timeouts += 1
+                yield json.dumps({
+                    'name': 'API Error',
+                    'description': 'The query took longer than ' + str(executor.timeout) + ' seconds',
+                }) + '\n'
+                return
+            if not chunk:
+                return
+            yield ''.join(chunk)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.future is not None and not self.future.done():
+                self.future.add_done_callback(self.executor.done)
+            else:
+                self.executor.done(self.future)
+            await self.body_iterator.aclose()
+
+
+executor = QueryExecutor()
+
+
+def snapshotGauges():
+    '''
+    Gauges describing this process, the loaded cache and the response cache,
+    computed when the metrics are scraped
+    '''
+    cachestats = responsecache.stats()
+    gauges = [
+        ('attackmatrix_worker_info', 'gauge', 'Process that answered the scrape: with --workers, every worker keeps '
+                                              'its own metrics.',
+         [({'pid': os.getpid()}, 1)]),
+        ('attackmatrix_responsecache_hits_total', 'counter', 'Number of responses served from the response cache.',
+         [({}, cachestats['hits'])]),
+        ('attackmatrix_responsecache_misses_total', 'counter', 'Number of responses not in the response cache.',
+         [({}, cachestats['misses'])]),
+        ('attackmatrix_responsecache_entries', 'gauge', 'Number of responses in the response cache.',
+         [({}, cachestats['entries'])]),
+        ('attackmatrix_responsecache_bytes', 'gauge', 'Size of the responses in the response cache.',
+         [({}, cachestats['bytes'])]),
+    ]
+    if executor.pool is not None:
+        gauges += [
+            ('attackmatrix_executor_pending', 'gauge', 'Number of queries running or waiting in the query executor.',
+             [({}, executor.pending)]),
+            ('attackmatrix_executor_rejected_total', 'counter', 'Number of queries refused because the query '
+                                                                'executor was saturated.',
+             [({}, executor.rejected)]),
+            ('attackmatrix_executor_timeouts_total', 'counter', 'Number of queries that timed out.',
+             [({}, executor.timeouts)]),
+        ]
+    snapshot = store.snapshot
+    if snapshot is not None:
+        gauges += [
+            ('attackmatrix_cache_info', 'gauge', 'Generation of the loaded cache.',
+             [({'generation': snapshot.generation}, 1)]),
+            ('attackmatrix_cache_bytes', 'gauge', 'Size of the loaded cachefile.', [({}, snapshot.size)]),
+            ('attackmatrix_cache_loadtime_seconds', 'gauge', 'Time it took to load the cache.',
+             [({}, snapshot.loadtime)]),
+            ('attackmatrix_cache_loaded_timestamp_seconds', 'gauge', 'When the cache was loaded.',
+             [({}, snapshot.loaded)]),
+            ('attackmatrix_cache_entities', 'gauge', 'Number of entities in the loaded cache.',
+             [({'category': category}, len(snapshot.cache[category])) for category in categories
+              if category in snapshot.cache]),
+            ('attackmatrix_cache_indexes', 'gauge', 'Number of indexes built for the loaded cache.',
+             [({}, len(snapshot.indexes))]),
+        ]
+    return gauges
+
+
+class Profiler:
+    '''
+    Sampling profiler for a single request: a background thread records the
+    stacks of the threads working on the request every interval, and counts
+    the samples per collapsed stack (as used by flamegraph.pl and speedscope).
+    Those are the thread handling the request, and any query executor thread
+    while it runs a query for the request (see attach()). Requests on the same
+    threads while the profiler runs are sampled as well.
+    '''
+    def __init__(self, threadid, interval=0.001):
+        self.id = os.urandom(8).hex()
+        self.threadids = {threadid}
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def attach(self):
+        '''
+        Sample the calling thread as well, until detach()
+        '''
+        self.threadids.add(threading.get_ident())
+
+    def detach(self):
+        self.threadids.discard(threading.get_ident())
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for threadid in list(self.threadids):
+                frame = frames.get(threadid)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join('%s %d\n' % (stack, count) for stack, count in self.samples.most_common())
+
+
+profiles = collections.OrderedDict()
+# The profiler of the request being handled, if it is profiled
+profiling = contextvars.ContextVar('profiling', default=None)
+
+
+class MetricsMiddleware:
+    '''
+    ASGI middleware recording the time and status of every request. A request
+    is timed until the last of its response has been sent, so streamed
+    responses are measured completely. Requests with an X-Profile header are
+    profiled, and the last 32 profiles are kept for /metrics/profiles/.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+        profiler = None
+        profile = dict(scope['headers']).get(b'x-profile')
+        if profile is not None and (not options.token or profile.decode('latin-1') == options.token):
+            profiler = Profiler(threading.get_ident())
+            profiler.start()
+        context = profiling.set(profiler)
+
+        async def sendMessage(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                if profiler:
+                    message = dict(message, headers=list(message.get('headers', [])) +
+                                   [(b'x-profile-id', profiler.id.encode('ascii'))])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, sendMessage)
+        finally:
+            profiling.reset(context)
+            route = scope.get('route')
+            route = getattr(route, 'path', 'unmatched')
+            metrics.observe('attackmatrix_request_seconds', time.perf_counter() - start, route=route)
+            metrics.increment('attackmatrix_requests_total', route=route, method=scope['method'], status=status[0])
+            if profiler:
+                profiler.stop()
+                profiles[profiler.id] = profiler
+                while len(profiles) > 32:
+                    profiles.popitem(last=False)
+
+
+app.add_middleware(MetricsMiddleware)
+
+
+@app.on_event('startup')
+async def loadStore():
+    store.warm = True
+    store.get(options).warm()
+
+
+@app.get('/', tags=['docs'])
+async def read_root():
+    return RedirectResponse('/docs')
+
+
+@app.get('/api/', tags=['docs'])
+async def read_api():
+    return RedirectResponse('/docs')
+
+
+@app.get('/api/explore/{treepath:path}', tags=['explore'])
+async def query(request: Request,
+                limit: Optional[int] = Query(None, ge=1),
+                cursor: Optional[str] = None,
+                fields: list = Query([]),
+                relationships: bool = True,
+                format: str = 'json',
+                token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    treepath = request.path_params['treepath']
+    if format == 'ndjson':
+        return executor.stream(exploreLines(options, treepath, limit=limit, cursor=cursor, fields=fields,
+                                            relationships=relationships, snapshot=store.get(options)),
+                               'application/x-ndjson')
+    return await cachedResponse(request, 'explore',
+                                lambda snapshot: explore(options, treepath, limit=limit, cursor=cursor, fields=fields,
+                                                         relationships=relationships, snapshot=snapshot),
+                                blocking='/' not in treepath.strip('/'), treepath=treepath, limit=limit,
+                                cursor=cursor, fields=tuple(fields), relationships=relationships)
+
+
+@app.get('/api/search', tags=['search'])
+async def searchParam(request: Request,
+                      params: list = Query([]),
+                      limit: Optional[int] = None,
+                      mode: str = 'index',
+                      token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    return await cachedResponse(request, 'search',
+                                lambda snapshot: search(options, params, limit=limit, mode=mode, snapshot=snapshot),
+                                params=tuple(param.lower() for param in params), limit=limit, mode=mode)
+
+
+@app.get('/api/resolve', tags=['resolve'])
+async def resolveNames(request: Request,
+                       names: list = Query([]),
+                       categories: list = Query([]),
+                       limit: int = 10,
+                       minimum: float = 0.5,
+                       token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    return await cachedResponse(request, 'resolve',
+                                lambda snapshot: resolve(options, names, resolvecategories=categories, limit=limit,
+                                                         minimum=minimum, snapshot=snapshot),
+                                names=tuple(names), categories=tuple(categories), limit=limit, minimum=minimum)
+
+
+@app.get('/api/actoroverlap', tags=['actoroverlap'])
+async def actorOverlap(request: Request,
+                       actors: list = Query([]),
+                       token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    return await cachedResponse(request, 'actoroverlap',
+                                lambda snapshot: findActorOverlap(options, actors, snapshot=snapshot),
+                                actors=tuple(actors))
+
+
+@app.get('/api/ttpoverlap', tags=['ttpoverlap'])
+async def ttpOverlap(request: Request,
+                     ttps: list = Query([]),
+                     minimum: Optional[int] = None,
+                     token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    return await cachedResponse(request, 'ttpoverlap',
+                                lambda snapshot: findTTPOverlap(options, ttps, minimum=minimum, snapshot=snapshot),
+                                ttps=tuple(ttps), minimum=minimum)
+
+
+@app.get('/api/actorsimilarity', tags=['actorsimilarity'])
+async def actorSimilarity(request: Request,
+                          actors: list = Query([]),
+                          metric: str = 'jaccard',
+                          top: Optional[int] = None,
+                          categories: list = Query(['Malwares', 'Techniques', 'Tools']),
+                          token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    return await cachedResponse(request, 'actorsimilarity',
+                                lambda snapshot: findActorSimilarity(options, actors, metric=metric, top=top,
+                                                                     ttpcategories=categories, snapshot=snapshot),
+                                actors=tuple(actors), metric=metric, top=top, categories=tuple(categories))
+
+
+@app.get('/api/graph/neighborhood', tags=['graph'])
+async def graphNeighborhood(request: Request,
+                            entity: str,
+                            hops: int = 1,
+                            categories: list = Query([]),
+                            limit: int = 500,
+                            token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    return await cachedResponse(request, 'neighborhood',
+                                lambda snapshot: findNeighborhood(options, entity, hops=hops, graphcategories=categories,
+                                                                  limit=limit, snapshot=snapshot),
+                                entity=entity, hops=hops, categories=tuple(categories), limit=limit)
+
+
+@app.get('/api/graph/path', tags=['graph'])
+async def graphPath(request: Request,
+                    source: str,
+                    target: str,
+                    categories: list = Query([]),
+                    token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    return await cachedResponse(request, 'path',
+                                lambda snapshot: findPath(options, source, target, graphcategories=categories,
+                                                          snapshot=snapshot),
+                                source=source, target=target, categories=tuple(categories))
+
+
+@app.get('/api/aggregates', tags=['aggregates'])
+async def aggregates(request: Request,
+                     token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    return await cachedResponse(request, 'aggregates', lambda snapshot: snapshot.cache.aggregates)
+
+
+@app.get('/api/heatmap', tags=['aggregates'])
+async def heatmap(request: Request,
+                  actors: list = Query([]),
+                  tactics: list = Query([]),
+                  token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    return await cachedResponse(request, 'heatmap',
+                                lambda snapshot: coverageHeatmap(options, actors, tactics, snapshot=snapshot),
+                                actors=tuple(actors), tactics=tuple(tactics))
+
+
+class Batch(BaseModel):
+    operations: List[dict] = []
+    stream: bool = False
+
+
+@app.post('/api/batch', tags=['batch'])
+async def batch(request: Request,
+                batch: Batch,
+                token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    snapshot = store.get(options)
+    if batch.stream:
+        return executor.stream(batchLines(options, batch.operations, snapshot=snapshot), 'application/x-ndjson')
+    body = await executor.run(serializedResult, 'batch',
+                              lambda snapshot: batchResults(options, batch.operations, snapshot), snapshot)
+    return Response(body, media_type='application/json')
+
+
+@app.get('/api/status', tags=['status'])
+async def status(request: Request,
+                 token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    snapshot = store.get(options)
+    if snapshot is None:
+        return {
+            'name': 'API Error',
+            'description': 'No cache has been loaded (yet)!'
+        }
+    return {
+        'generation': snapshot.generation,
+        'loaded': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(snapshot.loaded)),
+        'loadtime': round(snapshot.loadtime, 6),
+        'size': snapshot.size,
+        'entities': {category: len(snapshot.cache[category]) for category in categories if category in snapshot.cache},
+        'relationships': snapshot.relationships(),
+        'responsecache': responsecache.stats(),
+    }
+
+
+@app.get('/api/snapshots', tags=['snapshots'])
+async def snapshots(request: Request,
+                    token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    body = await executor.run(serializedResult, 'snapshots', lambda snapshot: listSnapshots(options), None)
+    return Response(body, media_type='application/json')
+
+
+@app.get('/api/diff', tags=['snapshots'])
+async def diff(request: Request,
+               old: str = 'previous',
+               new: str = 'latest',
+               token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    body = await executor.run(serializedResult, 'diff', lambda snapshot: diffSnapshots(options, old, new), None)
+    return Response(body, media_type='application/json')
+
+
+@app.get('/metrics', tags=['metrics'])
+async def prometheusMetrics(request: Request,
+                            token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    return Response(metrics.render(snapshotGauges()), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/metrics/profiles/{profileid}', tags=['metrics'])
+async def profile(request: Request,
+                  profileid: str,
+                  token: Optional[str] = None):
+    if options.token:
+        if token != options.token:
+            raise HTTPException(status_code=403, detail='Access denied: missing or incorrect token')
+    if profileid not in profiles:
+        return {
+            'name': 'API Error',
+            'description': 'Unknown profile! Only the last 32 profiles are kept, by the worker that recorded them.'
+        }
+    return Response(profiles[profileid].collapsed(), media_type='text/plain')
+
+
+def serveWorkers(options, workers):
+    '''
+    Production mode: load the cache and build all of its indexes once, then
+    fork workers that each serve the API on the same listening socket. The
+    loaded snapshot is frozen out of reach of the garbage collector before
+    forking, so the workers share its memory copy-on-write instead of each
+    loading (and holding) a copy of their own. Workers that exit are replaced
+    until the server is stopped. Metrics, profiles and the response cache are
+    kept per worker, and are not aggregated.
+    '''
+    store.warm = True
+    snapshot = store.get(options)
+    if snapshot is None:
+        logging.error('Cannot load the cachefile ' + str(options.cachefile))
+        return
+    snapshot.warm()
+    sock = socket.socket(socket.AF_INET6 if ':' in options.ip else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((options.ip, int(options.port)))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    config = uvicorn.Config(app, host=options.ip, port=int(options.port), log_level='info')
+    gc.collect()
+    gc.freeze()
+    children = set()
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    logging.info('Serving cache generation %s from %d workers' % (snapshot.generation, workers))
+    while True:
+        while not stopping and len(children) < workers:
+            pid = os.fork()
+            if pid == 0:
+                # A worker must never return into this loop, or it would start forking workers of its own
+                status = 1
+                try:
+                    signal.signal(signal.SIGINT, signal.SIG_DFL)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    uvicorn.Server(config).run(sockets=[sock])
+                    status = 0
+                except BaseException:
+                    logging.exception('Worker %d failed' % os.getpid())
+                finally:
+                    os._exit(status)
+            children.add(pid)
+        if not children:
+            break
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logging.warning('Worker %d exited with status %d, restarting it' % (pid, status))
+            time.sleep(1)
+    sock.close()
@@ -0,0 +1,2396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# (c) 2021 Arnim Eijkhoudt (arnime <thingamajic> kpn-cert.nl), GPLv3
+#
+# Please note: the MITRE ATT&CK® framework is a registered trademark
+# of MITRE. See https://attack.mitre.org/ for more information.
+#
+# I would like to thank MITRE for the permissive licence under which
+# ATT&CK® is available.
+#
+
+import array
+import base64
+import bisect
+import collections
+import collections.abc
+import difflib
+import functools
+import gc
+import heapq
+import itertools
+import logging
+import json
+import mmap
+import os
+import pathlib
+import re
+import string
+import struct
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, so peak memory usage cannot be reported there
+    resource = None
+from config.matrixtable import Matrices
+# concurrent.futures, hashlib, multiprocessing, pprint, shutil and
+# urllib.request are slow to import and not needed to answer queries, so the
+# functions using them import them when they run
+
+
+# The engine's public names, which attackmatrix and matrixapi re-export with
+# "from matrixengine import *" (without the modules imported above)
+__all__ = [
+    'typemap', 'categories', 'Entity', 'legacyFlags', 'Matrix', 'MappedMatrix', 'EntityTable', 'saveBinary',
+    'CategoryView', 'Snapshot', 'MatrixStore', 'store', 'Metrics', 'metrics', 'runBatch', 'batchResults',
+    'batchLines', 'explore', 'exploreLines', 'iterCategory', 'nextCursor', 'buildPositionIndex', 'project',
+    'findActorOverlap', 'findActorSimilarity', 'similarity', 'findTTPOverlap', 'coverageHeatmap', 'buildTTPIndex',
+    'buildActorIndex', 'relatedIDs', 'atLeast', 'popcount', 'iterBits', 'search', 'trigrams', 'buildSearchIndex',
+    'searchIndex', 'scoreDocument', 'resolve', 'normalizeName', 'buildAliasIndex', 'resolveName',
+    'findNeighborhood', 'findPath', 'resolveEntity', 'renderGraph', 'batchoperations', 'indexbuilders', 'loadCache',
+    'saveCache', 'iterObjects', 'parseObject', 'parseMatrix', 'computeAggregates', 'matrixSignature',
+    'loadFingerprints', 'saveFingerprints', 'buildstats', 'GenerateMatrix', 'peakRSS', 'UpdateMatrix', 'cacheKey',
+    'matrixDefinitions', 'relationshipPairs', 'entityRecord', 'contentHash', 'saveSnapshot', 'listSnapshots',
+    'loadSnapshot', 'loadSnapshotObject', 'diffSnapshots', 'DownloadMatrices', 'downloadMatrix', 'queryLines',
+    'queryLine',
+]
+
+
+typemap = collections.OrderedDict({
+    'intrusion-set': 'Actors',
+    'campaign': 'Campaigns',
+    'malware': 'Malwares',
+    'course-of-action': 'Mitigations',
+    'x-mitre-tactic': 'Tactics',
+    'attack-pattern': 'Techniques',
+    'tool': 'Tools',
+    'uid': 'UID',
+})
+categories=[
+    'Actors',
+    'Campaigns',
+    'Malwares',
+    'Matrices',
+    'Mitigations',
+    'Tactics',
+    'Techniques',
+    'Tools'
+]
+
+
+class Entity:
+    '''
+    A single ATT&CK® entity: its metadata, whether MITRE has revoked or
+    deprecated it, the (numbers of the) matrices it was found in, and the
+    numbers of all entities it has a relationship with
+    '''
+    __slots__ = ('category', 'mitreid', 'name', 'description', 'url', 'matrices', 'edges', 'revoked', 'deprecated')
+
+    def __init__(self, category, mitreid, name=(), description=(), url=(), matrices=(), edges=(), revoked=False,
+                 deprecated=False):
+        self.category = category
+        self.mitreid = mitreid
+        self.name = tuple(name)
+        self.description = tuple(description)
+        self.url = tuple(url)
+        self.matrices = tuple(matrices)
+        self.edges = array.array('I', edges)
+        self.revoked = bool(revoked)
+        self.deprecated = bool(deprecated)
+
+
+def legacyFlags(descriptions):
+    '''
+    Caches written before entities kept their revoked and deprecated flags only
+    have the notes parseObject() appends to the description, so derive the
+    flags from those
+    '''
+    notes = ' '.join(descriptions)
+    return 'has been **revoked**' in notes, 'has been **deprecated**' in notes
+
+
+class Matrix(collections.abc.Mapping):
+    '''
+    Normalized merged matrix: every entity is stored once, numbered in order of
+    creation, and relationships are kept as arrays of entity numbers. Metadata
+    is only copied into the nested dicts the API returns when an entity is
+    rendered, so a relationship does not hold its own copy of the metadata.
+    For compatibility, a Matrix can be used like the nested dict the cache
+    used to be: matrix[category][mitreid] renders that entity.
+    '''
+    format = 'attackmatrix-normalized'
+
+    def __init__(self):
+        self.entities = []
+        self.ids = {category: {} for category in categories}
+        # Precomputed statistics, see computeAggregates()
+        self.aggregates = {}
+
+    def __getitem__(self, category):
+        return CategoryView(self, category)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def number(self, category, mitreid):
+        return self.ids[category][mitreid]
+
+    def entity(self, category, mitreid):
+        return self.entities[self.ids[category][mitreid]]
+
+    def add(self, category, mitreid):
+        '''
+        Return the number of the entity category/mitreid, creating it if needed
+        '''
+        if mitreid not in self.ids[category]:
+            self.ids[category][mitreid] = len(self.entities)
+            self.entities.append(Entity(category, mitreid))
+        return self.ids[category][mitreid]
+
+    def remove(self, number):
+        entity = self.entities[number]
+        for neighbour in list(entity.edges):
+            self.unlink(number, neighbour)
+        del self.ids[entity.category][entity.mitreid]
+        self.entities[number] = None
+
+    def link(self, source, target):
+        if target not in self.entities[source].edges:
+            self.entities[source].edges.append(target)
+        if source not in self.entities[target].edges:
+            self.entities[target].edges.append(source)
+
+    def unlink(self, source, target):
+        if target in self.entities[source].edges:
+            self.entities[source].edges.remove(target)
+        if source in self.entities[target].edges:
+            self.entities[target].edges.remove(source)
+
+    def category(self, number):
+        return self.entities[number].category
+
+    def mitreid(self, number):
+        return self.entities[number].mitreid
+
+    def neighbours(self, number):
+        return self.entities[number].edges
+
+    def relationships(self):
+        return sum(len(entity.edges) for entity in self.entities if entity is not None) // 2
+
+    def metadata(self, number):
+        entity = self.entities[number]
+        return {
+            'name': list(entity.name),
+            'description': list(entity.description),
+            'url': list(entity.url),
+        }
+
+    def render(self, number, relationships=True):
+        '''
+        Render an entity in the nested dict format of the API, optionally
+        without the entities it is related to
+        '''
+        entity = self.entities[number]
+        record = {'Metadata': self.metadata(number)}
+        if entity.category != 'Matrices':
+            record['Matrices'] = {self.entities[matrix].mitreid: self.metadata(matrix) for matrix in entity.matrices}
+        if not relationships:
+            return record
+        for neighbour in entity.edges:
+            other = self.entities[neighbour]
+            if other.category not in record:
+                record[other.category] = {}
+            record[other.category][other.mitreid] = self.metadata(neighbour)
+        return record
+
+    def todict(self):
+        '''
+        Render the complete matrix as a nested dict
+        '''
+        return {category: self[category].todict() for category in self}
+
+    def dump(self):
+        '''
+        Return the normalized matrix as a JSON-serializable dict. Entities are
+        renumbered to skip the ones that have been removed.
+        '''
+        numbers = {}
+        for number, entity in enumerate(self.entities):
+            if entity is not None:
+                numbers[number] = len(numbers)
+        return {
+            'format': self.format,
+            'entities': [[entity.category, entity.mitreid, entity.name, entity.description, entity.url,
+                          [numbers[matrix] for matrix in entity.matrices],
+                          [numbers[neighbour] for neighbour in entity.edges], entity.revoked, entity.deprecated]
+                         for entity in self.entities if entity is not None],
+            'aggregates': self.aggregates,
+        }
+
+    @classmethod
+    def load(cls, data):
+        '''
+        Create a Matrix from either a dump() or an old-style nested dict cache
+        '''
+        matrix = cls()
+        if data.get('format') == cls.format:
+            for record in data['entities']:
+                if len(record) == 7:
+                    record = record + list(legacyFlags(record[3]))
+                matrix.ids[record[0]][record[1]] = len(matrix.entities)
+                matrix.entities.append(Entity(*record))
+            matrix.aggregates = data.get('aggregates', {})
+            return matrix
+        for category in categories:
+            for mitreid in data.get(category, {}):
+                metadata = data[category][mitreid]['Metadata']
+                entity = matrix.entities[matrix.add(category, mitreid)]
+                entity.name = tuple(metadata['name'])
+                entity.description = tuple(metadata['description'])
+                entity.url = tuple(metadata['url'])
+                entity.revoked, entity.deprecated = legacyFlags(entity.description)
+        for category in categories:
+            for mitreid in data.get(category, {}):
+                entity = matrix.entity(category, mitreid)
+                for key in data[category][mitreid]:
+                    if key == 'Matrices' and category != 'Matrices':
+                        entity.matrices = tuple(matrix.number('Matrices', other)
+                                                for other in data[category][mitreid][key])
+                    elif key not in ('Metadata', 'Matrices'):
+                        entity.edges.extend(matrix.number(key, other) for other in data[category][mitreid][key])
+        return matrix
+
+
+class MappedMatrix(Matrix):
+    '''
+    Read-only Matrix backed by a memory-mapped binary cachefile (see
+    saveBinary()). Opening one only builds the category/MITRE ID lookup
+    tables: all other data is decoded from the mapped file when an entity is
+    accessed, and the pages of that file are shared by all processes that
+    have it mapped.
+    '''
+    # The arrays are stored in native byte order, which is part of the magic
+    magic = b'AMTXBI3' + (b'L' if sys.byteorder == 'little' else b'B')
+    header = struct.Struct('=8s4I7Q')
+    # The category of a record is stored in its low byte, its flags above that
+    categorymask = 0xff
+    revokedflag = 0x100
+    deprecatedflag = 0x200
+    # Older versions of the format lack the flags (version 2) and the aggregates
+    # (version 1), but are still read
+    magicv2 = b'AMTXBI2' + magic[-1:]
+    magicv1 = b'AMTXBIN' + magic[-1:]
+    headerv1 = struct.Struct('=8s4I5Q')
+
+    def __init__(self, cachefile):
+        with open(cachefile, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.legacyflags = self.mmap[:8] != self.magic
+        if self.mmap[:8] in (self.magic, self.magicv2):
+            (magic, self.count, stringcount, listcount, edgecount, records, lists, edges, stringoffsets,
+             strings, aggregates, aggregatessize) = self.header.unpack_from(self.mmap)
+        elif self.mmap[:8] == self.magicv1:
+            (magic, self.count, stringcount, listcount, edgecount,
+             records, lists, edges, stringoffsets, strings) = self.headerv1.unpack_from(self.mmap)
+            aggregates = aggregatessize = 0
+        else:
+            raise ValueError('Not a binary cachefile: ' + str(cachefile))
+        self.aggregatesblob = (aggregates, aggregatessize)
+        self.decodedaggregates = None
+        view = memoryview(self.mmap)
+        self.records = view[records:records + 20 * self.count].cast('I')
+        self.lists = view[lists:lists + 4 * listcount].cast('I')
+        self.edges = view[edges:edges + 4 * edgecount].cast('I')
+        self.stringoffsets = view[stringoffsets:stringoffsets + 8 * (stringcount + 1)].cast('Q')
+        self.strings = view[strings:]
+        self.entities = EntityTable(self)
+        self.ids = {category: {} for category in categories}
+        for number in range(self.count):
+            self.ids[self.category(number)][self.string(self.records[5 * number + 1])] = number
+
+    def string(self, number):
+        return str(self.strings[self.stringoffsets[number]:self.stringoffsets[number + 1]], 'utf-8')
+
+    # Traversals only need these, so read them from the records directly
+    # instead of decoding the complete entity
+
+    def category(self, number):
+        return categories[self.records[5 * number] & self.categorymask]
+
+    def mitreid(self, number):
+        return self.string(self.records[5 * number + 1])
+
+    def neighbours(self, number):
+        edgestart, edgecount = self.records[5 * number + 3:5 * number + 5]
+        return self.edges[edgestart:edgestart + edgecount]
+
+    def relationships(self):
+        return len(self.edges) // 2
+
+    @property
+    def aggregates(self):
+        if self.decodedaggregates is None:
+            offset, size = self.aggregatesblob
+            self.decodedaggregates = json.loads(bytes(self.mmap[offset:offset + size])) if size else {}
+        return self.decodedaggregates
+
+    @staticmethod
+    def isbinary(cachefile):
+        with open(cachefile, 'rb') as f:
+            return f.read(len(MappedMatrix.magic)) in (MappedMatrix.magic, MappedMatrix.magicv2, MappedMatrix.magicv1)
+
+
+class EntityTable(collections.abc.Sequence):
+    '''
+    The entities of a MappedMatrix, decoded from their fixed-width records of
+    (category and flags, MITRE ID string, start in the lists array, start and
+    length in the edges array). The lists array holds, for every entity, the counts and
+    string numbers of its names, descriptions and urls, followed by the count
+    and numbers of its matrices.
+    '''
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def __len__(self):
+        return self.matrix.count
+
+    def __getitem__(self, number):
+        matrix = self.matrix
+        if not 0 <= number < matrix.count:
+            raise IndexError(number)
+        category, mitreid, position, edgestart, edgecount = matrix.records[5 * number:5 * number + 5]
+        fields = []
+        for field in range(4):
+            count = matrix.lists[position]
+            fields.append(matrix.lists[position + 1:position + 1 + count])
+            position += 1 + count
+        names, descriptions, urls, matrices = fields
+        descriptions = [matrix.string(string) for string in descriptions]
+        if matrix.legacyflags:
+            revoked, deprecated = legacyFlags(descriptions)
+        else:
+            revoked, deprecated = category & matrix.revokedflag, category & matrix.deprecatedflag
+        return Entity(categories[category & matrix.categorymask], matrix.string(mitreid),
+                      [matrix.string(string) for string in names],
+                      descriptions,
+                      [matrix.string(string) for string in urls],
+                      matrices, matrix.edges[edgestart:edgestart + edgecount], revoked, deprecated)
+
+
+def saveBinary(matrix, f):
+    '''
+    Write a Matrix to the binary file f in the format MappedMatrix reads: a
+    header followed by the entity records, the lists and edges arrays, the
+    string offsets, the (deduplicated) UTF-8 strings and the aggregates as
+    JSON, each section aligned to 8 bytes
+    '''
+    numbers = {}
+    for number, entity in enumerate(matrix.entities):
+        if entity is not None:
+            numbers[number] = len(numbers)
+    strings = {}
+    def intern(string):
+        if string not in strings:
+            strings[string] = len(strings)
+        return strings[string]
+    records = array.array('I')
+    lists = array.array('I')
+    edges = array.array('I')
+    for entity in matrix.entities:
+        if entity is None:
+            continue
+        flags = ((MappedMatrix.revokedflag if entity.revoked else 0) |
+                 (MappedMatrix.deprecatedflag if entity.deprecated else 0))
+        records.extend((categories.index(entity.category) | flags, intern(cacheKey(entity.mitreid)),
+                        len(lists), len(edges), len(entity.edges)))
+        for values in (entity.name, entity.description, entity.url):
+            lists.append(len(values))
+            lists.extend(intern(value) for value in values)
+        lists.append(len(entity.matrices))
+        lists.extend(numbers[number] for number in entity.matrices)
+        edges.extend(numbers[number] for number in entity.edges)
+    encoded = [string.encode('utf-8') for string in strings]
+    stringoffsets = array.array('Q', [0])
+    for string in encoded:
+        stringoffsets.append(stringoffsets[-1] + len(string))
+    aggregates = json.dumps(matrix.aggregates, separators=(',', ':')).encode('utf-8')
+    sections = [records.tobytes(), lists.tobytes(), edges.tobytes(), stringoffsets.tobytes(), b''.join(encoded),
+                aggregates]
+    offsets = []
+    position = MappedMatrix.header.size
+    for section in sections:
+        position += -position % 8
+        offsets.append(position)
+        position += len(section)
+    f.write(MappedMatrix.header.pack(MappedMatrix.magic, len(numbers), len(strings), len(lists), len(edges), *offsets,
+                                     len(aggregates)))
+    for offset, section in zip(offsets, sections):
+        f.write(b'\0' * (offset - f.tell()))
+        f.write(section)
+
+
+class CategoryView(collections.abc.Mapping):
+    '''
+    Read-only view of one category of a Matrix, rendering entities on access
+    '''
+    def __init__(self, matrix, category):
+        self.matrix = matrix
+        self.ids = matrix.ids[category]
+
+    def __getitem__(self, mitreid):
+        return self.matrix.render(self.ids[mitreid])
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, mitreid):
+        return mitreid in self.ids
+
+    def todict(self):
+        return {mitreid: self.matrix.render(number) for mitreid, number in self.ids.items()}
+
+
+class Snapshot:
+    '''
+    One fully loaded generation of the merged matrix. A snapshot is never
+    modified after it has been created: a changed cachefile results in a new
+    snapshot, so requests holding on to the old one are unaffected.
+    '''
+    def __init__(self, cache, path, mtime, size, loadtime):
+        self.cache = cache
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.loadtime = loadtime
+        self.loaded = time.time()
+        self.generation = '%x-%x' % (mtime, size)
+        self.indexes = {}
+        self.relationshipcount = None
+        self.lock = threading.Lock()
+
+    def index(self, name):
+        '''
+        Return the derived index *name* (see indexbuilders) for this snapshot,
+        building it on first use
+        '''
+        try:
+            return self.indexes[name]
+        except KeyError:
+            with self.lock:
+                if name not in self.indexes:
+                    start = time.perf_counter()
+                    self.indexes[name] = indexbuilders[name](self.cache)
+                    elapsed = time.perf_counter() - start
+                    metrics.observe('attackmatrix_stage_seconds', elapsed, stage='index.' + name)
+                    logging.info('Built the %s index for cache generation %s in %.3fs' %
+                                 (name, self.generation, elapsed))
+            return self.indexes[name]
+
+    def relationships(self):
+        if self.relationshipcount is None:
+            self.relationshipcount = self.cache.relationships()
+        return self.relationshipcount
+
+    def warm(self):
+        for name in indexbuilders:
+            self.index(name)
+
+
+class MatrixStore:
+    '''
+    Process-wide store that keeps the merged matrix resident in memory, so the
+    cachefile is only parsed once instead of on every API call. The cachefile
+    is stat()'ed on every access: when its modification time or size changes,
+    a new snapshot is loaded in a background thread while the old one keeps
+    being served, after which the new snapshot replaces it in one assignment.
+    If warm is set, all indexes are built before a new snapshot is swapped in.
+    A snapshot is only served for the cachefile it was loaded from: asking for
+    another cachefile loads that one right away. A cachefile that fails to load
+    is not retried until its modification time or size changes again.
+    '''
+    def __init__(self, warm=False):
+        self.snapshot = None
+        self.warm = warm
+        self.failed = None
+        self.lock = threading.Lock()
+
+    def get(self, options):
+        path = os.path.realpath(options.cachefile)
+        try:
+            stat = os.stat(options.cachefile)
+            version = (path, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stat = version = None
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.path != path:
+            with self.lock:
+                if (self.snapshot is None or self.snapshot.path != path) and version != self.failed:
+                    self.reload(options)
+            snapshot = self.snapshot
+            return snapshot if snapshot is not None and snapshot.path == path else None
+        if stat is None:
+            return snapshot
+        if (stat.st_mtime_ns, stat.st_size) != (snapshot.mtime, snapshot.size) and version != self.failed:
+            if self.lock.acquire(blocking=False):
+                threading.Thread(target=self.refresh, args=(options,), daemon=True).start()
+        return snapshot
+
+    def refresh(self, options):
+        try:
+            self.reload(options)
+        finally:
+            self.lock.release()
+
+    def reload(self, options):
+        '''
+        (Re)load the cachefile into a new snapshot. Must be called with the lock
+        held. If loading fails, the current snapshot (if any) stays in place and
+        the version of the cachefile that failed is remembered in failed.
+        '''
+        path = os.path.realpath(options.cachefile)
+        try:
+            stat = os.stat(options.cachefile)
+        except OSError:
+            logging.error('Cannot access the cachefile ' + str(options.cachefile))
+            return
+        start = time.perf_counter()
+        try:
+            cache = loadCache(options)
+        except Exception:
+            logging.exception('Cannot load the cachefile ' + str(options.cachefile))
+            cache = None
+        if cache is None:
+            self.failed = (path, stat.st_mtime_ns, stat.st_size)
+            return
+        snapshot = Snapshot(cache, path, stat.st_mtime_ns, stat.st_size, time.perf_counter() - start)
+        if self.warm:
+            snapshot.warm()
+        self.snapshot = snapshot
+        self.failed = None
+        logging.info('Loaded cache generation %s (%d bytes) in %.3fs' %
+                     (self.snapshot.generation, self.snapshot.size, self.snapshot.loadtime))
+
+
+store = MatrixStore()
+
+
+class Metrics:
+    '''
+    Minimal registry of histograms and counters, rendered in the Prometheus
+    text format. Recording a value takes a lock and a bisect, so the
+    instrumentation can be left on in production.
+    '''
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+    descriptions = {
+        'attackmatrix_stage_seconds': ('histogram', 'Time spent in every stage of loading the cache and answering '
+                                                    'queries.'),
+        'attackmatrix_serialize_seconds': ('histogram', 'Time spent serializing responses to JSON.'),
+        'attackmatrix_request_seconds': ('histogram', 'Time spent handling requests, including streaming the '
+                                                      'response.'),
+        'attackmatrix_requests_total': ('counter', 'Number of requests handled.'),
+    }
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Count per bucket (the last one being +Inf), count and sum
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def timed(self, stage):
+        '''
+        Decorator recording the duration of every call of a function as a stage
+        '''
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe('attackmatrix_stage_seconds', time.perf_counter() - start, stage=stage)
+            return wrapper
+        return decorator
+
+    def render(self, gauges=[]):
+        '''
+        Render all metrics, plus the given gauges as (name, description,
+        [(labels, value), ...]), in the Prometheus text format
+        '''
+        families = collections.OrderedDict()
+        with self.lock:
+            for (name, labels), (counts, count, total) in sorted(self.histograms.items()):
+                samples = families.setdefault(name, [])
+                cumulative = 0
+                for bound, bucketcount in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucketcount
+                    samples.append((name + '_bucket', labels + (('le', bound),), cumulative))
+                samples.append((name + '_count', labels, count))
+                samples.append((name + '_sum', labels, total))
+            for (name, labels), value in sorted(self.counters.items()):
+                families.setdefault(name, []).append((name, labels, value))
+        lines = []
+        for name, samples in families.items():
+            type, description = self.descriptions.get(name, ('untyped', name))
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, type))
+            lines += [self.sample(*sample) for sample in samples]
+        for name, type, description, samples in gauges:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, type))
+            lines += [self.sample(name, tuple(sorted(labels.items())), value) for labels, value in samples]
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def sample(name, labels, value):
+        if labels:
+            name += '{' + ','.join('%s="%s"' % (label, str(labelvalue).replace('\\', '\\\\').replace('"', '\\"')
+                                                .replace('\n', '\\n')) for label, labelvalue in labels) + '}'
+        return '%s %s' % (name, repr(float(value)) if isinstance(value, float) else value)
+
+
+metrics = Metrics()
+
+
+def runBatch(options, operations, snapshot=None):
+    '''
+    Run a list of operations (dicts with an 'op' and the keyword arguments of
+    the function implementing it) against one snapshot, yielding every result
+    and the time it took in order
+    '''
+    snapshot = snapshot or store.get(options)
+    for operation in operations:
+        start = time.perf_counter()
+        try:
+            arguments = dict(operation)
+            function = batchoperations[arguments.pop('op', None)]
+            if 'options' in arguments or 'snapshot' in arguments:
+                raise TypeError('invalid parameter')
+            result = function(options, snapshot=snapshot, **arguments)
+        except KeyError:
+            result = {
+                'name': 'API Error',
+                'description': 'Unknown operation! Choose from: ' + ', '.join(batchoperations),
+            }
+        except TypeError as e:
+            result = {
+                'name': 'API Error',
+                'description': 'Invalid parameters for operation ' + str(operation.get('op')) + ': ' + str(e),
+            }
+        yield result, time.perf_counter() - start
+
+
+def batchResults(options, operations, snapshot=None):
+    '''
+    Collect the results of runBatch() and their timings in a single response
+    '''
+    start = time.perf_counter()
+    results = []
+    timings = []
+    for result, elapsed in runBatch(options, operations, snapshot=snapshot):
+        results.append(result)
+        timings.append(round(elapsed, 6))
+    return {
+        'results': results,
+        'count': len(results),
+        'timing': {
+            'total': round(time.perf_counter() - start, 6),
+            'operations': timings,
+        },
+    }
+
+
+def batchLines(options, operations, snapshot=None):
+    '''
+    Generate the results of runBatch() as newline-delimited JSON, followed by
+    a line with the total time taken
+    '''
+    start = time.perf_counter()
+    for index, (result, elapsed) in enumerate(runBatch(options, operations, snapshot=snapshot)):
+        yield json.dumps({'index': index, 'result': result, 'time': round(elapsed, 6)}) + '\n'
+    yield json.dumps({'count': len(operations), 'time': round(time.perf_counter() - start, 6)}) + '\n'
+
+
+@metrics.timed('explore')
+def explore(options, treepath='', limit=None, cursor=None, fields=[], relationships=True, snapshot=None):
+    try:
+        results = {}
+        snapshot = snapshot or store.get(options)
+        cache = snapshot.cache
+        if limit is not None and limit < 1:
+            results = {
+                'name': 'API Error',
+                'description': 'The limit must be at least 1!'
+            }
+        elif not treepath:
+            results = {
+                'Metadata': {
+                    'name': 'AttackMatrix API',
+                    'description': 'Available keys: ' + ', '.join(key for key in cache),
+                    'matrices': cache['Matrices'].todict(),
+                },
+            }
+        else:
+            treepath = treepath.split('/')
+            if len(treepath)>1:
+                results = project(cache.render(cache.number(treepath[0], treepath[1]), relationships), fields)
+            elif limit is None and cursor is None:
+                results = dict(iterCategory(cache, treepath[0], fields=fields, relationships=relationships))
+            else:
+                entities = iterCategory(cache, treepath[0], cursor=cursor, fields=fields, relationships=relationships,
+                                        order=snapshot.index('positions')[treepath[0]])
+                results = {'entities': dict(itertools.islice(entities, limit))}
+                results['cursor'] = nextCursor(cache, treepath[0], results['entities'])
+    except KeyError:
+        results = {}
+    except ValueError:
+        results = {
+            'name': 'API Error',
+            'description': 'Invalid cursor!'
+        }
+    finally:
+        return results
+
+
+def exploreLines(options, treepath='', limit=None, cursor=None, fields=[], relationships=True, snapshot=None):
+    '''
+    Generate the output of explore() as newline-delimited JSON, one entity at a
+    time. When a limit is given, the last line holds the cursor of the next
+    page, if there is one. An unknown category or an invalid cursor gives the
+    same single line that explore() answers it with.
+    '''
+    split = treepath.split('/')
+    if len(split) != 1 or not treepath or (limit is not None and limit < 1):
+        yield json.dumps(explore(options, treepath, limit=limit, fields=fields, relationships=relationships,
+                                 snapshot=snapshot)) + '\n'
+        return
+    try:
+        snapshot = snapshot or store.get(options)
+        cache = snapshot.cache
+        entities = iterCategory(cache, treepath, cursor=cursor, fields=fields, relationships=relationships,
+                                order=snapshot.index('positions')[treepath])
+        last = None
+        for mitreid, record in itertools.islice(entities, limit):
+            last = mitreid
+            yield json.dumps({'category': treepath, 'id': mitreid, 'entity': record}) + '\n'
+        if limit is not None:
+            next = nextCursor(cache, treepath, [last] if last is not None else [])
+            if next:
+                yield json.dumps({'cursor': next}) + '\n'
+    except KeyError:
+        yield json.dumps({}) + '\n'
+    except ValueError:
+        yield json.dumps({
+            'name': 'API Error',
+            'description': 'Invalid cursor!'
+        }) + '\n'
+
+
+def iterCategory(cache, category, cursor=None, fields=[], relationships=True, order=None):
+    '''
+    Yield the (MITRE ID, rendered entity) of all entities in a category, starting
+    after the entity the cursor points at. A cursor is looked up in *order*, the
+    category's entry in the positions index, so resuming from it does not scan
+    the entities before it.
+    '''
+    ids = cache.ids[category]
+    if not cursor:
+        for mitreid in ids:
+            yield mitreid, project(cache.render(ids[mitreid], relationships), fields)
+        return
+    mitreids, positions = order
+    last = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    if last not in positions:
+        raise ValueError('Invalid cursor')
+    for position in range(positions[last] + 1, len(mitreids)):
+        yield mitreids[position], project(cache.render(ids[mitreids[position]], relationships), fields)
+
+
+def nextCursor(cache, category, page):
+    '''
+    Return the cursor pointing after the last entity of a page, or None if that
+    was the last entity in the category
+    '''
+    last = None
+    for last in page:
+        pass
+    if last is None or last == next(reversed(cache.ids[category]), None):
+        return None
+    return base64.urlsafe_b64encode(last.encode('utf-8')).decode('ascii')
+
+
+def buildPositionIndex(cache):
+    '''
+    Build the order of the entities of every category: the list of their MITRE
+    IDs, and the position of every MITRE ID in that list
+    '''
+    index = {}
+    for category in cache.ids:
+        mitreids = list(cache.ids[category])
+        index[category] = (mitreids, {mitreid: position for position, mitreid in enumerate(mitreids)})
+    return index
+
+
+def project(record, fields):
+    '''
+    Return only the given dotted fields (e.g. Metadata.name) of a rendered
+    entity, or all of it when no fields are given
+    '''
+    if not fields:
+        return record
+    projection = {}
+    for field in fields:
+        keys = field.split('.')
+        value = record
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = projection
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return projection
+
+
+@metrics.timed('actoroverlap')
+def findActorOverlap(options, actors=[], snapshot=None):
+    try:
+        response = {}
+        if not len(actors)>1:
+            response = {
+                'name': 'API Error',
+                'description': 'Specify at least two Actors to check for overlap!'
+            }
+        else:
+            snapshot = snapshot or store.get(options)
+            cache = snapshot.cache
+            index = snapshot.index('actors')
+            records = [cache['Actors'][actor] for actor in actors]
+            shared = index['all']
+            for actor in actors:
+                shared &= index['rows'][index['actornumbers'][actor]]
+            # Render the shared TTPs in the order the first actor lists them
+            ttps = {}
+            for category in categories:
+                if shared & index['masks'].get(category, 0) and category in records[0]:
+                    columns = index['columns'][category]
+                    ttps[category] = {ttp: records[0][category][ttp] for ttp in records[0][category]
+                                      if shared >> columns[ttp] & 1}
+            response = {}
+            for actor, record in zip(actors, records):
+                response[actor] = dict(ttps)
+                response[actor]['Metadata'] = record['Metadata']
+            response['count'] = float(popcount(shared))
+    except Exception as e:
+            response = {
+                'name': 'Python Error',
+                'description': str(type(e))+': '+str(e),
+            }
+    finally:
+        return response
+
+
+@metrics.timed('actorsimilarity')
+def findActorSimilarity(options, actors=[], metric='jaccard', top=None, ttpcategories=['Malwares', 'Techniques', 'Tools'],
+                        snapshot=None):
+    try:
+        response = {}
+        if metric not in ('jaccard', 'overlap'):
+            response = {
+                'name': 'API Error',
+                'description': 'The metric must be either \'jaccard\' or \'overlap\'!'
+            }
+        elif top is not None and len(actors) != 1:
+            response = {
+                'name': 'API Error',
+                'description': 'Specify exactly one Actor to find the most similar Actors for!'
+            }
+        else:
+            snapshot = snapshot or store.get(options)
+            cache = snapshot.cache
+            index = snapshot.index('actors')
+            if not actors:
+                actors = index['actors']
+            unknown = [actor for actor in actors if actor not in index['actornumbers']]
+            if unknown:
+                response = {
+                    'name': 'API Error',
+                    'description': 'Unknown Actor(s): ' + ', '.join(unknown),
+                }
+            else:
+                mask = 0
+                for category in ttpcategories:
+                    mask |= index['masks'].get(category, 0)
+                rows = [index['rows'][index['actornumbers'][actor]] & mask for actor in actors]
+                sizes = [popcount(row) for row in rows]
+                if top is not None:
+                    row, size = rows[0], sizes[0]
+                    scores = []
+                    for number, other in enumerate(index['actors']):
+                        if other == actors[0]:
+                            continue
+                        otherrow = index['rows'][number] & mask
+                        scores.append((similarity(metric, row, size, otherrow, popcount(otherrow)), other))
+                    response = {
+                        'actor': actors[0],
+                        'metric': metric,
+                        'similar': [{
+                            'actor': other,
+                            'name': list(cache.entity('Actors', other).name),
+                            'score': round(score, 4),
+                        } for score, other in heapq.nlargest(max(top, 0), scores, key=lambda item: item[0])],
+                    }
+                else:
+                    matrix = [[1.0] * len(actors) for actor in actors]
+                    for i in range(len(actors)):
+                        for j in range(i+1, len(actors)):
+                            matrix[i][j] = matrix[j][i] = round(similarity(metric, rows[i], sizes[i], rows[j], sizes[j]), 4)
+                    response = {
+                        'actors': actors,
+                        'metric': metric,
+                        'matrix': matrix,
+                    }
+    except Exception as e:
+            response = {
+                'name': 'Python Error',
+                'description': str(type(e))+': '+str(e),
+            }
+    finally:
+        return response
+
+
+def similarity(metric, a, asize, b, bsize):
+    '''
+    Jaccard or overlap coefficient of two TTP bitsets with known sizes
+    '''
+    shared = popcount(a & b)
+    if metric == 'jaccard':
+        union = asize + bsize - shared
+        return shared / union if union else 0.0
+    smallest = min(asize, bsize)
+    return shared / smallest if smallest else 0.0
+
+
+@metrics.timed('ttpoverlap')
+def findTTPOverlap(options, ttps=[], minimum=None, snapshot=None):
+    try:
+        response = {}
+        if not len(ttps)>1:
+            response = {
+                'name': 'API Error',
+                'description': 'Specify at least two TTPs to check for overlap!'
+            }
+        else:
+            snapshot = snapshot or store.get(options)
+            cache = snapshot.cache
+            index = snapshot.index('ttps')
+            bitsets = [index['ttps'].get(ttp, 0) for ttp in set(ttps)]
+            if minimum is None or minimum >= len(bitsets):
+                matches = index['all']
+                for bitset in sorted(bitsets, key=popcount):
+                    matches &= bitset
+            else:
+                matches = atLeast(bitsets, minimum, index['all'])
+            response = {}
+            for actor in iterBits(matches):
+                actor = index['actors'][actor]
+                response[actor] = cache['Actors'][actor]
+    except Exception as e:
+            response = {
+                'name': 'Python Error',
+                'description': str(type(e))+': '+str(e),
+            }
+    finally:
+        return response
+
+
+@metrics.timed('heatmap')
+def coverageHeatmap(options, actors=[], tactics=[], snapshot=None):
+    try:
+        response = {}
+        snapshot = snapshot or store.get(options)
+        cache = snapshot.cache
+        aggregates = cache.aggregates
+        actornumbers = snapshot.index('actors')['actornumbers']
+        unknownactors = [actor for actor in actors if actor not in actornumbers]
+        unknowntactics = [tactic for tactic in tactics if tactic not in aggregates.get('tactics', {})]
+        if not aggregates.get('tactics'):
+            response = {
+                'name': 'API Error',
+                'description': 'The cache has no tactics for its techniques: regenerate it with -f!'
+            }
+        elif unknownactors:
+            response = {
+                'name': 'API Error',
+                'description': 'Unknown Actors: ' + ', '.join(unknownactors),
+            }
+        elif unknowntactics:
+            response = {
+                'name': 'API Error',
+                'description': 'Unknown Tactics: ' + ', '.join(unknowntactics),
+            }
+        else:
+            # The TTP index has the bitset of the actors using every technique,
+            # so the number of given actors using one is a single & and popcount
+            index = snapshot.index('ttps')
+            mask = 0
+            for actor in actors:
+                mask |= 1 << actornumbers[actor]
+            mask = mask or index['all']
+            response = {
+                'actors': popcount(mask),
+                'tactics': {},
+            }
+            for tactic in tactics or aggregates['tactics']:
+                counts = {technique: popcount(index['ttps'].get(technique, 0) & mask)
+                          for technique in aggregates['tactics'][tactic]['techniques']}
+                used = sum(1 for count in counts.values() if count)
+                response['tactics'][tactic] = {
+                    'name': list(cache.entity('Tactics', tactic).name),
+                    'techniques': counts,
+                    'used': used,
+                    'total': len(counts),
+                    'coverage': round(used / len(counts), 4) if counts else 0.0,
+                }
+    except Exception as e:
+        response = {
+            'name': 'Python Error',
+            'description': str(type(e))+': '+str(e),
+        }
+    finally:
+        return response
+
+
+def buildTTPIndex(cache):
+    '''
+    Build an inverted index from every TTP (i.e. every ID an actor is related to,
+    in any category) to the set of actors that have it. Actors are numbered in
+    cache order, and a set of actors is a Python int with the bits of the actor
+    numbers set, so combining sets of actors is a single & or | operation.
+    '''
+    actors = list(cache['Actors'])
+    ttps = collections.defaultdict(int)
+    for number, actor in enumerate(actors):
+        bit = 1 << number
+        for category, ttp in relatedIDs(cache, cache.entity('Actors', actor)):
+            ttps[ttp] |= bit
+    return {
+        'actors': actors,
+        'all': (1 << len(actors)) - 1,
+        'ttps': dict(ttps),
+    }
+
+
+def buildActorIndex(cache):
+    '''
+    Build a boolean actor x TTP matrix. Every (category, ID) an actor is related
+    to is a column, and every actor's row is a Python int with the bits of its
+    columns set, so comparing actors boils down to & and popcount on two ints.
+    masks holds the columns of each category, to restrict a comparison to e.g.
+    Techniques only.
+    '''
+    actors = list(cache['Actors'])
+    columns = collections.defaultdict(dict)
+    masks = collections.defaultdict(int)
+    rows = []
+    count = 0
+    for actor in actors:
+        row = 0
+        for category, ttp in relatedIDs(cache, cache.entity('Actors', actor)):
+            if ttp not in columns[category]:
+                columns[category][ttp] = count
+                masks[category] |= 1 << count
+                count += 1
+            row |= 1 << columns[category][ttp]
+        rows.append(row)
+    return {
+        'actors': actors,
+        'actornumbers': {actor: number for number, actor in enumerate(actors)},
+        'all': sum(masks.values()),
+        'columns': dict(columns),
+        'masks': dict(masks),
+        'rows': rows,
+    }
+
+
+def relatedIDs(cache, entity):
+    '''
+    Yield the (category, MITRE ID) of everything an entity is related to,
+    including the matrices it was found in
+    '''
+    for number in itertools.chain(entity.matrices, entity.edges):
+        yield cache.category(number), cache.mitreid(number)
+
+
+def atLeast(bitsets, minimum, universe):
+    '''
+    Return the bitset of everything that is set in at least minimum of the
+    bitsets. levels[i] holds everything seen in at least i of the bitsets
+    processed so far, so this takes len(bitsets) * minimum bitwise operations
+    instead of counting per actor.
+    '''
+    if minimum <= 0:
+        return universe
+    levels = [universe] + [0] * minimum
+    for bitset in bitsets:
+        for level in range(minimum, 0, -1):
+            levels[level] |= levels[level-1] & bitset
+    return levels[minimum]
+
+
+# int.bit_count() is only available from Python 3.10 onwards
+popcount = getattr(int, 'bit_count', lambda bitset: bin(bitset).count('1'))
+
+
+def iterBits(bitset):
+    '''
+    Yield the numbers of all bits set in bitset, lowest first
+    '''
+    while bitset:
+        lowest = bitset & -bitset
+        yield lowest.bit_length() - 1
+        bitset ^= lowest
+
+
+@metrics.timed('search')
+def search(options, params=[], limit=None, mode='index', snapshot=None):
+    try:
+        response = {}
+        if not len(params):
+            response = {
+                'name': 'API Error',
+                'description': 'Specify at least one search parameter!'
+            }
+        elif mode not in ('index', 'scan'):
+            response = {
+                'name': 'API Error',
+                'description': 'The search mode must be either \'index\' or \'scan\'!'
+            }
+        else:
+            snapshot = snapshot or store.get(options)
+            cache = snapshot.cache
+            terms = [term.lower() for term in params]
+            response = collections.defaultdict(lambda: {})
+            if mode == 'index':
+                index = snapshot.index('search')
+                matches = searchIndex(index, terms)
+            else:
+                index = None
+                matches = []
+                for category in categories:
+                    for object in cache[category]:
+                        entity = cache.entity(category, object)
+                        contents = ' '.join(entity.name)
+                        contents += ' '.join(entity.description)
+                        contents += ' '.join(entity.url)
+                        if all(term in contents.lower() for term in terms):
+                            matches.append((category, object))
+            if limit is not None:
+                if index is None:
+                    index = snapshot.index('search')
+                scores = ((scoreDocument(index, index['documents'][match], terms), match) for match in matches)
+                ranking = heapq.nlargest(max(limit, 0), scores, key=lambda item: item[0])
+                matches = [match for score, match in ranking]
+            for category, object in matches:
+                response[category][object] = cache[category][object]
+            response['count'] = sum(len(response[item]) for item in response)
+            if limit is not None:
+                response['ranking'] = [[category, object, score] for score, (category, object) in ranking]
+    except Exception as e:
+        response = {
+            'name': 'Python Error',
+            'description': str(type(e))+': '+str(e),
+        }
+    finally:
+        return response
+
+
+def trigrams(text):
+    return {text[i:i+3] for i in range(len(text)-2)}
+
+
+def buildSearchIndex(cache):
+    '''
+    Build an inverted trigram index over the names, descriptions and urls of all
+    entities. Every entity gets a document number (in the same order a full scan
+    of the cache would visit them), and every trigram maps to the ascending
+    array of document numbers that contain it.
+    '''
+    keys = []
+    documents = {}
+    contents = []
+    names = []
+    postings = collections.defaultdict(lambda: array.array('I'))
+    for category in categories:
+        for object in cache[category]:
+            entity = cache.entity(category, object)
+            text = ' '.join(entity.name)
+            text += ' '.join(entity.description)
+            text += ' '.join(entity.url)
+            text = text.lower()
+            document = len(keys)
+            keys.append((category, object))
+            documents[(category, object)] = document
+            contents.append(text)
+            names.append(' '.join(entity.name).lower())
+            for trigram in trigrams(text):
+                postings[trigram].append(document)
+    return {
+        'keys': keys,
+        'documents': documents,
+        'contents': contents,
+        'names': names,
+        'postings': dict(postings),
+    }
+
+
+def searchIndex(index, terms):
+    '''
+    Return the (category, MITRE ID) keys of all documents containing every term,
+    in document order. The trigrams of all terms narrow the documents down to a
+    set of candidates by intersecting their posting lists (smallest first), and
+    the candidates are then checked for the actual substrings.
+    '''
+    postings = []
+    for term in terms:
+        for trigram in trigrams(term):
+            if trigram not in index['postings']:
+                return []
+            postings.append(index['postings'][trigram])
+    if postings:
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+        candidates = sorted(candidates)
+    else:
+        candidates = range(len(index['keys']))
+    contents = index['contents']
+    return [index['keys'][document] for document in candidates
+            if all(term in contents[document] for term in terms)]
+
+
+def scoreDocument(index, document, terms):
+    '''
+    Relevance score of a matching document: the number of occurrences of every
+    term, with occurrences in the entity's names weighing ten times as much
+    '''
+    contents = index['contents'][document]
+    names = index['names'][document]
+    return sum(contents.count(term) + 9 * names.count(term) for term in terms)
+
+
+@metrics.timed('resolve')
+def resolve(options, names=[], resolvecategories=[], limit=10, minimum=0.5, snapshot=None):
+    try:
+        response = {}
+        if not len(names):
+            response = {
+                'name': 'API Error',
+                'description': 'Specify at least one name to resolve!'
+            }
+        elif any(category not in categories for category in resolvecategories):
+            response = {
+                'name': 'API Error',
+                'description': 'Unknown category! Choose from: ' + ', '.join(categories),
+            }
+        else:
+            index = (snapshot or store.get(options)).index('aliases')
+            for name in names:
+                response[name] = resolveName(index, name, set(resolvecategories), limit, minimum)
+    except Exception as e:
+        response = {
+            'name': 'Python Error',
+            'description': str(type(e))+': '+str(e),
+        }
+    finally:
+        return response
+
+
+def normalizeName(name):
+    '''
+    Normalize a name for matching: lowercase, without whitespace or punctuation,
+    so e.g. 'APT 29', 'apt-29' and 'APT29' are all the same name
+    '''
+    return re.sub(r'[\W_]+', '', name.lower())
+
+
+def buildAliasIndex(cache):
+    '''
+    Build the index used to resolve free-text names: every normalized name,
+    alias and MITRE ID of every entity maps to the aliases with that exact
+    normalized form, and every trigram of a normalized alias (padded with
+    spaces, so short aliases have trigrams too) maps to the ascending array of
+    aliases containing it
+    '''
+    aliases = []
+    exact = collections.defaultdict(list)
+    postings = collections.defaultdict(lambda: array.array('I'))
+    for category in categories:
+        for mitreid in cache.ids[category]:
+            if mitreid == cacheKey(None):
+                continue
+            entity = cache.entity(category, mitreid)
+            seen = set()
+            for name in (mitreid,) + tuple(entity.name):
+                normalized = normalizeName(name)
+                if not normalized or normalized in seen:
+                    continue
+                seen.add(normalized)
+                alias = len(aliases)
+                aliases.append((normalized, category, mitreid, name))
+                exact[normalized].append(alias)
+                for trigram in trigrams(' ' + normalized + ' '):
+                    postings[trigram].append(alias)
+    return {
+        'aliases': aliases,
+        'exact': dict(exact),
+        'postings': dict(postings),
+    }
+
+
+def resolveName(index, name, allowed=set(), limit=10, minimum=0.5, candidates=200):
+    '''
+    Return the entities best matching name, as dicts of their category, MITRE
+    ID, the matching alias and its score. Exact matches of the normalized name
+    score 1. Otherwise, the aliases sharing the most trigrams with the name are
+    the candidates, scored by their similarity to the name (the ratio of
+    difflib.SequenceMatcher). Every entity is only returned with its best
+    matching alias.
+    '''
+    normalized = normalizeName(name)
+    if not normalized:
+        return []
+    aliases = index['aliases']
+    best = {}
+    def match(alias, score):
+        normalized, category, mitreid, original = aliases[alias]
+        if (allowed and category not in allowed) or score < minimum:
+            return
+        if score > best.get((category, mitreid), (-1,))[0]:
+            best[(category, mitreid)] = (score, original)
+    for alias in index['exact'].get(normalized, []):
+        match(alias, 1.0)
+    shared = collections.Counter()
+    for trigram in trigrams(' ' + normalized + ' '):
+        shared.update(index['postings'].get(trigram, ()))
+    matcher = difflib.SequenceMatcher(b=normalized)
+    for alias, count in shared.most_common(candidates):
+        matcher.set_seq1(aliases[alias][0])
+        match(alias, matcher.ratio())
+    ranking = sorted(best.items(), key=lambda item: (-item[1][0], item[0]))[:max(limit, 0)]
+    return [{'category': category, 'mitreid': mitreid, 'alias': alias, 'score': round(score, 3)}
+            for (category, mitreid), (score, alias) in ranking]
+
+
+@metrics.timed('neighborhood')
+def findNeighborhood(options, entity, hops=1, graphcategories=[], limit=500, snapshot=None):
+    try:
+        snapshot = snapshot or store.get(options)
+        cache = snapshot.cache
+        start = resolveEntity(cache, entity)
+        allowed = set(graphcategories)
+        # Breadth-first search, remembering the distance of every node found
+        distances = {start: 0}
+        frontier = [start]
+        truncated = False
+        for hop in range(1, max(hops, 0) + 1):
+            next = []
+            for number in frontier:
+                for neighbour in cache.neighbours(number):
+                    if neighbour in distances:
+                        continue
+                    if allowed and cache.category(neighbour) not in allowed:
+                        continue
+                    if len(distances) >= limit:
+                        truncated = True
+                        break
+                    distances[neighbour] = hop
+                    next.append(neighbour)
+            frontier = next
+        response = renderGraph(cache, distances)
+        response['truncated'] = truncated
+    except KeyError:
+        response = {
+            'name': 'API Error',
+            'description': 'Unknown entity: ' + str(entity),
+        }
+    except Exception as e:
+        response = {
+            'name': 'Python Error',
+            'description': str(type(e))+': '+str(e),
+        }
+    finally:
+        return response
+
+
+@metrics.timed('path')
+def findPath(options, source, target, graphcategories=[], snapshot=None):
+    try:
+        snapshot = snapshot or store.get(options)
+        cache = snapshot.cache
+        reference = source
+        start = resolveEntity(cache, source)
+        reference = target
+        end = resolveEntity(cache, target)
+        allowed = set(graphcategories)
+        # Breadth-first search, remembering where every node was reached from
+        parents = {start: None}
+        frontier = [start]
+        while frontier and end not in parents:
+            next = []
+            for number in frontier:
+                for neighbour in cache.neighbours(number):
+                    if neighbour in parents:
+                        continue
+                    if allowed and neighbour != end and cache.category(neighbour) not in allowed:
+                        continue
+                    parents[neighbour] = number
+                    next.append(neighbour)
+            frontier = next
+        path = []
+        if end in parents:
+            number = end
+            while number is not None:
+                path.append(number)
+                number = parents[number]
+            path.reverse()
+        response = renderGraph(cache, {number: hop for hop, number in enumerate(path)}, path=True)
+        response['found'] = bool(path)
+    except KeyError:
+        response = {
+            'name': 'API Error',
+            'description': 'Unknown entity: ' + str(reference),
+        }
+    except Exception as e:
+        response = {
+            'name': 'Python Error',
+            'description': str(type(e))+': '+str(e),
+        }
+    finally:
+        return response
+
+
+def resolveEntity(cache, reference):
+    '''
+    Return the number of the entity given as Category/ID or as just its ID
+    (found in the first category that has it)
+    '''
+    if '/' in reference:
+        category, mitreid = reference.split('/', 1)
+        return cache.number(category, mitreid)
+    for category in categories:
+        if reference in cache.ids[category]:
+            return cache.number(category, reference)
+    raise KeyError(reference)
+
+
+def renderGraph(cache, distances, path=False):
+    '''
+    Render the entities in distances (entity number: hops from the start) as
+    nodes, with either all relationships between them or just those along a
+    path as edges
+    '''
+    nodes = []
+    edges = []
+    for number, hops in distances.items():
+        category, mitreid = cache.category(number), cache.mitreid(number)
+        metadata = cache.entities[number].name
+        nodes.append({
+            'id': category + '/' + mitreid,
+            'category': category,
+            'mitreid': mitreid,
+            'name': metadata[0] if metadata else mitreid,
+            'hops': hops,
+        })
+        if path:
+            if hops:
+                edges.append({'source': nodes[-2]['id'], 'target': nodes[-1]['id']})
+            continue
+        for neighbour in cache.neighbours(number):
+            if neighbour in distances and number < neighbour:
+                edges.append({
+                    'source': category + '/' + mitreid,
+                    'target': cache.category(neighbour) + '/' + cache.mitreid(neighbour),
+                })
+    return {
+        'nodes': nodes,
+        'edges': edges,
+    }
+
+
+batchoperations = {
+    'explore': explore,
+    'search': search,
+    'resolve': resolve,
+    'actoroverlap': findActorOverlap,
+    'ttpoverlap': findTTPOverlap,
+    'actorsimilarity': findActorSimilarity,
+    'neighborhood': findNeighborhood,
+    'path': findPath,
+    'heatmap': coverageHeatmap,
+}
+
+
+indexbuilders = {
+    'positions': buildPositionIndex,
+    'search': buildSearchIndex,
+    'aliases': buildAliasIndex,
+    'ttps': buildTTPIndex,
+    'actors': buildActorIndex,
+}
+
+
+@metrics.timed('loadcache')
+def loadCache(options):
+    '''
+    Load the cachefile, which can be in either the JSON or the binary format
+    '''
+    cachefile = pathlib.Path(options.cachefile)
+    if options.verbose:
+        logging.info('Loading cache ' + cachefile.name + '...')
+    try:
+        if MappedMatrix.isbinary(cachefile):
+            return MappedMatrix(cachefile)
+        with open(cachefile, 'r') as cache:
+            return Matrix.load(json.loads(cache.read()))
+    except (ValueError, FileNotFoundError):
+        if options.verbose:
+            logging.error('Error loading the cachefile ' + cachefile.name)
+
+
+@metrics.timed('savecache')
+def saveCache(options, cache):
+    '''
+    Write the cache to a temporary file first and rename it over the cachefile,
+    so a running daemon never picks up a half-written cache
+    '''
+    cachefile = pathlib.Path(options.cachefile)
+    tempfile = cachefile.with_name(cachefile.name + '.tmp')
+    if getattr(options, 'cacheformat', 'json') == 'binary':
+        with open(tempfile, 'wb') as f:
+            saveBinary(cache, f)
+    else:
+        with open(tempfile, 'w') as f:
+            json.dump(cache.dump(), f, separators=(',', ':'))
+    os.replace(tempfile, cachefile)
+
+
+def iterObjects(matrixfile, chunksize=1<<20):
+    '''
+    Yield the objects of a STIX bundle one at a time, reading the file in chunks
+    of chunksize characters, so the complete bundle never has to be in memory
+    '''
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[\s,]*')
+    with open(matrixfile, 'r') as f:
+        buffer = ''
+        eof = False
+        start = None
+        while start is None:
+            chunk = f.read(chunksize)
+            if not chunk:
+                raise ValueError('No objects found in ' + str(matrixfile))
+            buffer += chunk
+            match = re.search(r'"objects"\s*:\s*\[', buffer)
+            if match:
+                start = match.end()
+        buffer = buffer[start:]
+        position = 0
+        while True:
+            position = whitespace.match(buffer, position).end()
+            if position < len(buffer):
+                if buffer[position] == ']':
+                    return
+                try:
+                    object, position = decoder.raw_decode(buffer, position)
+                    yield object
+                    continue
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            elif eof:
+                raise ValueError('Unexpected end of the objects in ' + str(matrixfile))
+            chunk = f.read(chunksize)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def parseObject(object):
+    '''
+    Extract the MITRE ID and metadata of an ATT&CK object: returns a tuple of
+    (category, STIX UID, MITRE ID, names, descriptions, urls, revoked,
+    deprecated)
+    '''
+    type = typemap[object['type']]
+    objectnames = []
+    objectdescriptions = []
+    objecturls = []
+    uid = object['id']
+    mitreid = None
+    revoked = False
+    deprecated = False
+    if 'description' in object:
+        objectdescriptions.append(object['description'])
+    if 'revoked' in object:
+        revoked = object['revoked']
+    if 'x_mitre_deprecated' in object:
+        deprecated = object['x_mitre_deprecated']
+    if 'external_references' in object:
+        for external_reference in object['external_references']:
+            if 'external_id' in external_reference:
+                if 'mitre' in external_reference['source_name']:
+                    mitreid = external_reference['external_id']
+                    if 'name' in object:
+                        objectnames.append(object['name'])
+                    if 'aliases' in object:
+                        for alias in object['aliases']:
+                            if alias not in objectnames:
+                                objectnames.append(alias)
+                    if 'description' in object:
+                        if object['description'] not in objectdescriptions:
+                            objectdescriptions.append(object['description'])
+                    if 'url' in external_reference:
+                        objecturls.append(external_reference['url'])
+    if revoked:
+        objectdescriptions.append('Note: This MITRE ID has been **revoked** and should no longer be used.\n')
+    if deprecated:
+        objectdescriptions.append('Note: This MITRE ID has been **deprecated** and should no longer be used.\n')
+    return (type, uid, mitreid, objectnames, objectdescriptions, objecturls, bool(revoked), bool(deprecated))
+
+
+def parseMatrix(matrixfile):
+    '''
+    Parse one STIX bundle in a single pass: returns the parsed ATT&CK objects
+    (see parseObject), the (source UID, target UID) pairs of all relationships
+    between them and the fingerprint of the bundle. Relationships can refer to
+    objects that appear later in the bundle, or in another bundle altogether,
+    so they are only resolved once all bundles have been parsed.
+    The fingerprint records the STIX modified timestamp of every object and
+    relationship, so a later UpdateMatrix() can tell what has changed. It also
+    records the kill chain phases of every technique and the shortname of
+    every tactic, which computeAggregates() uses to find the tactics of the
+    techniques.
+    '''
+    import pprint
+    objects = []
+    relationships = []
+    fingerprint = {'objects': {}, 'relationships': {}, 'phases': {}, 'shortnames': {}}
+    for object in iterObjects(matrixfile):
+        try:
+            if object['type'] in typemap:
+                parsed = parseObject(object)
+                objects.append(parsed)
+                fingerprint['objects'][object['id']] = [object.get('modified'), parsed[0], parsed[2],
+                                                        object.get('revoked', False)]
+                phases = [phase['phase_name'] for phase in object.get('kill_chain_phases', [])
+                          if phase.get('kill_chain_name', '').startswith('mitre')]
+                if phases:
+                    fingerprint['phases'][object['id']] = phases
+                if 'x_mitre_shortname' in object:
+                    fingerprint['shortnames'][object['id']] = object['x_mitre_shortname']
+            elif object['type'] == 'relationship':
+                sourceuid = object['source_ref']
+                targetuid = object['target_ref']
+                if sourceuid.split('--')[0] in typemap and targetuid.split('--')[0] in typemap:
+                    relationships.append((sourceuid, targetuid))
+                    fingerprint['relationships'][object['id']] = [object.get('modified'), sourceuid, targetuid]
+        except:
+            print("Failed to parse a JSON object:")
+            pprint.pprint(object)
+            raise
+    return objects, relationships, fingerprint
+
+
+def computeAggregates(cache, fingerprints):
+    '''
+    Precompute the statistics that are stored with the cache: for every
+    technique, the number of actors using it and of mitigations for it; for
+    every tactic, its techniques, the number of actors using any of them and
+    the number of them that have a mitigation; for every mitigation, the
+    number of techniques it mitigates; and the tactic x technique
+    co-occurrence of all actors, i.e. how many actors use every technique of
+    every tactic. Techniques belong to the tactics whose shortnames are among
+    their kill chain phases, in the same bundle.
+    '''
+    tactics = collections.defaultdict(set)
+    for matrix in fingerprints:
+        objects = fingerprints[matrix]['objects']
+        shortnames = {shortname: cacheKey(objects[uid][2])
+                      for uid, shortname in fingerprints[matrix].get('shortnames', {}).items()}
+        for uid, phases in fingerprints[matrix].get('phases', {}).items():
+            technique = cacheKey(objects[uid][2])
+            for phase in phases:
+                if phase in shortnames and technique in cache.ids['Techniques']:
+                    tactics[shortnames[phase]].add(technique)
+    techniques = {}
+    actorsets = {}
+    for technique in cache.ids['Techniques']:
+        entity = cache.entity('Techniques', technique)
+        related = collections.Counter(cache.category(neighbour) for neighbour in entity.edges)
+        techniques[technique] = {'actors': related['Actors'], 'mitigations': related['Mitigations']}
+        actorsets[technique] = {neighbour for neighbour in entity.edges if cache.category(neighbour) == 'Actors'}
+    mitigations = {}
+    for mitigation in cache.ids['Mitigations']:
+        entity = cache.entity('Mitigations', mitigation)
+        mitigations[mitigation] = sum(1 for neighbour in entity.edges if cache.category(neighbour) == 'Techniques')
+    aggregates = {
+        'techniques': techniques,
+        'mitigations': mitigations,
+        'tactics': {},
+        'cooccurrence': {},
+    }
+    for tactic in sorted(tactics):
+        members = sorted(tactics[tactic])
+        aggregates['tactics'][tactic] = {
+            'techniques': members,
+            'actors': len(set().union(*(actorsets[technique] for technique in members))),
+            'mitigated': sum(1 for technique in members if techniques[technique]['mitigations']),
+        }
+        aggregates['cooccurrence'][tactic] = {technique: techniques[technique]['actors'] for technique in members}
+    return aggregates
+
+
+def matrixSignature(matrixfile):
+    stat = os.stat(matrixfile)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def loadFingerprints(options):
+    try:
+        with open(options.cachedir+'/fingerprints.json', 'r') as f:
+            return json.load(f)
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+def saveFingerprints(options, fingerprints):
+    fingerprintfile = pathlib.Path(options.cachedir+'/fingerprints.json')
+    tempfile = fingerprintfile.with_name(fingerprintfile.name + '.tmp')
+    with open(tempfile, 'w') as f:
+        json.dump(fingerprints, f)
+    os.replace(tempfile, fingerprintfile)
+
+
+# Timing and memory statistics of the last GenerateMatrix() run
+buildstats = {}
+
+
+def GenerateMatrix(options):
+    import concurrent.futures
+    start = time.perf_counter()
+    buildstats.clear()
+    merged = Matrix()
+    uids = {}
+    matrixfiles = {}
+    for matrix in Matrices:
+        matrixfile = pathlib.Path(options.cachedir+'/'+Matrices[matrix]['file'])
+        if not matrixfile.exists():
+            # Missing ATT&CK matrix file
+            continue
+        matrixfiles[matrix] = matrixfile
+    # Parse all bundles in parallel, but merge them in the order of the Matrices
+    workers = min(len(matrixfiles), os.cpu_count() or 1) or 1
+    fingerprints = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        parsed = {matrix: pool.submit(parseMatrix, matrixfiles[matrix]) for matrix in matrixfiles}
+        relationships = []
+        for matrix in parsed:
+            objects, matrixrelationships, fingerprints[matrix] = parsed[matrix].result()
+            fingerprints[matrix]['signature'] = matrixSignature(matrixfiles[matrix])
+            relationships += matrixrelationships
+            matrixnumber = merged.add('Matrices', matrix)
+            entity = merged.entities[matrixnumber]
+            entity.name = (Matrices[matrix]['name'],)
+            entity.description = (Matrices[matrix]['description'],)
+            entity.url = (Matrices[matrix]['url'],)
+            # Create all objects
+            for type, uid, mitreid, objectnames, objectdescriptions, objecturls, revoked, deprecated in objects:
+                mitreid = cacheKey(mitreid)
+                new = mitreid not in merged.ids[type]
+                number = merged.add(type, mitreid)
+                entity = merged.entities[number]
+                entity.name = tuple(objectnames)
+                entity.description = tuple(objectdescriptions)
+                entity.url = tuple(objecturls)
+                entity.revoked = revoked
+                entity.deprecated = deprecated
+                # Add the matrix the ID was first found in
+                if new:
+                    entity.matrices = (matrixnumber,)
+                uids[uid] = number
+    parsetime = time.perf_counter() - start
+    # Create all relationships
+    for sourceuid, targetuid in relationships:
+        try:
+            merged.link(uids[sourceuid], uids[targetuid])
+        except KeyError:
+            print("Failed to build a relationship between:")
+            print(sourceuid, '->', targetuid)
+            raise
+    linktime = time.perf_counter() - start - parsetime
+    aggregatestart = time.perf_counter()
+    merged.aggregates = computeAggregates(merged, fingerprints)
+    metrics.observe('attackmatrix_stage_seconds', time.perf_counter() - aggregatestart,
+                    stage='generatematrix.aggregates')
+    saveFingerprints(options, fingerprints)
+    metrics.observe('attackmatrix_stage_seconds', parsetime, stage='generatematrix.parse')
+    metrics.observe('attackmatrix_stage_seconds', linktime, stage='generatematrix.link')
+    metrics.observe('attackmatrix_stage_seconds', time.perf_counter() - start, stage='generatematrix')
+    buildstats.update({
+        'matrices': len(matrixfiles),
+        'relationships': len(relationships),
+        'parsetime': round(parsetime, 3),
+        'buildtime': round(time.perf_counter() - start, 3),
+        'peakrss': peakRSS(),
+    })
+    logging.info('Generated the matrix from %(matrices)d matrices and %(relationships)d relationships in '
+                 '%(buildtime).3fs (parsing: %(parsetime).3fs), peak RSS %(peakrss)s kB' % buildstats)
+    return merged
+
+
+def peakRSS():
+    '''
+    Peak resident set size in kB of this process or any of its (e.g. parser)
+    child processes, or None if that cannot be determined on this platform
+    '''
+    if resource is None:
+        return None
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+@metrics.timed('updatematrix')
+def UpdateMatrix(options, cache):
+    '''
+    Incrementally update a merged cache (as loaded from the cachefile) with the
+    changes in the matrix files since the last GenerateMatrix() or
+    UpdateMatrix() run, using the fingerprints that run left in the cachedir.
+    Only the bundles whose files changed are parsed, and only the objects and
+    relationships whose STIX modified timestamps differ from the fingerprints
+    are applied. The differences are appended to changelog.jsonl in the
+    cachedir. Falls back to a full GenerateMatrix() whenever the changes cannot
+    be applied incrementally.
+    '''
+    import concurrent.futures
+    start = time.perf_counter()
+    buildstats.clear()
+    previous = loadFingerprints(options)
+    matrixfiles = {}
+    for matrix in Matrices:
+        matrixfile = pathlib.Path(options.cachedir+'/'+Matrices[matrix]['file'])
+        if matrixfile.exists():
+            matrixfiles[matrix] = matrixfile
+    if cache is None or previous is None or set(previous) != set(matrixfiles) or \
+            any('phases' not in previous[matrix] for matrix in previous):
+        logging.info('No usable previous cache or fingerprints: generating the complete matrix')
+        return GenerateMatrix(options)
+    changed = [matrix for matrix in matrixfiles
+               if matrixSignature(matrixfiles[matrix]) != previous[matrix]['signature']]
+    if not changed:
+        logging.info('None of the matrices have changed since the last build')
+        buildstats['changes'] = 0
+        return cache
+    if isinstance(cache, MappedMatrix):
+        # Mapped matrices are read-only
+        cache = Matrix.load(cache.dump())
+    fingerprints = dict(previous)
+    records = {}
+    workers = min(len(changed), os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        parsed = {matrix: pool.submit(parseMatrix, matrixfiles[matrix]) for matrix in changed}
+        for matrix in parsed:
+            objects, relationships, fingerprints[matrix] = parsed[matrix].result()
+            fingerprints[matrix]['signature'] = matrixSignature(matrixfiles[matrix])
+            # The last definition of an ID in a bundle wins, as in GenerateMatrix()
+            records[matrix] = {(type, cacheKey(mitreid)): (names, descriptions, urls, revoked, deprecated)
+                               for type, uid, mitreid, names, descriptions, urls, revoked, deprecated in objects}
+    olddefinitions = matrixDefinitions(previous)
+    newdefinitions = matrixDefinitions(fingerprints)
+    changelog = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'matrices': changed,
+        'added': [],
+        'changed': [],
+        'revoked': [],
+        'removed': [],
+        'relationships': {'added': [], 'removed': []},
+    }
+    # Find the IDs whose objects were added, changed or removed in any bundle
+    touched = set()
+    for matrix in changed:
+        old, new = previous[matrix]['objects'], fingerprints[matrix]['objects']
+        for uid in new:
+            if uid not in old or old[uid] != new[uid]:
+                touched.add((new[uid][1], cacheKey(new[uid][2])))
+                if uid in old and new[uid][3] and not old[uid][3]:
+                    changelog['revoked'].append(new[uid][1] + '/' + cacheKey(new[uid][2]))
+            if uid in old and old[uid][1:3] != new[uid][1:3]:
+                touched.add((old[uid][1], cacheKey(old[uid][2])))
+        for uid in old:
+            if uid not in new:
+                touched.add((old[uid][1], cacheKey(old[uid][2])))
+    # Apply the changed metadata, which comes from the last matrix defining an ID
+    removed = []
+    for type, mitreid in sorted(touched):
+        key = (type, mitreid)
+        if key not in newdefinitions:
+            removed.append(key)
+            continue
+        winner = newdefinitions[key][-1]
+        if winner not in records:
+            logging.info('Cannot update %s/%s without reparsing %s: generating the complete matrix' %
+                         (type, mitreid, winner))
+            return GenerateMatrix(options)
+        if key in olddefinitions:
+            changelog['changed'].append(type + '/' + mitreid)
+        else:
+            changelog['added'].append(type + '/' + mitreid)
+        names, descriptions, urls, revoked, deprecated = records[winner][key]
+        entity = cache.entities[cache.add(type, mitreid)]
+        entity.name = tuple(names)
+        entity.description = tuple(descriptions)
+        entity.url = tuple(urls)
+        entity.revoked = revoked
+        entity.deprecated = deprecated
+        entity.matrices = (cache.number('Matrices', newdefinitions[key][0]),)
+    # Apply the relationships that appeared or disappeared in all bundles
+    oldpairs = relationshipPairs(previous)
+    newpairs = relationshipPairs(fingerprints)
+    if newpairs is None:
+        logging.info('Unresolvable relationships: generating the complete matrix')
+        return GenerateMatrix(options)
+    for sourcetype, sourcemitreid, targettype, targetmitreid in newpairs - oldpairs:
+        cache.link(cache.number(sourcetype, sourcemitreid), cache.number(targettype, targetmitreid))
+        changelog['relationships']['added'].append([sourcetype + '/' + sourcemitreid,
+                                                    targettype + '/' + targetmitreid])
+    for sourcetype, sourcemitreid, targettype, targetmitreid in oldpairs - newpairs:
+        if sourcemitreid in cache.ids[sourcetype] and targetmitreid in cache.ids[targettype]:
+            cache.unlink(cache.number(sourcetype, sourcemitreid), cache.number(targettype, targetmitreid))
+        changelog['relationships']['removed'].append([sourcetype + '/' + sourcemitreid,
+                                                      targettype + '/' + targetmitreid])
+    # Finally remove the IDs that are no longer defined in any bundle
+    for type, mitreid in removed:
+        if mitreid in cache.ids[type]:
+            cache.remove(cache.number(type, mitreid))
+            changelog['removed'].append(type + '/' + mitreid)
+    cache.aggregates = computeAggregates(cache, fingerprints)
+    saveFingerprints(options, fingerprints)
+    with open(options.cachedir+'/changelog.jsonl', 'a') as f:
+        f.write(json.dumps(changelog) + '\n')
+    buildstats.update({
+        'matrices': len(changed),
+        'changes': len(touched) + len(changelog['relationships']['added']) + len(changelog['relationships']['removed']),
+        'buildtime': round(time.perf_counter() - start, 3),
+        'peakrss': peakRSS(),
+    })
+    logging.info('Updated the matrix with %(changes)d changes from %(matrices)d matrices in %(buildtime).3fs, '
+                 'peak RSS %(peakrss)s kB' % buildstats)
+    return cache
+
+
+def cacheKey(mitreid):
+    '''
+    Objects without a MITRE ID end up under None, which is stored as 'null'
+    in the JSON cachefile
+    '''
+    return 'null' if mitreid is None else mitreid
+
+
+def matrixDefinitions(fingerprints):
+    '''
+    Map every (category, MITRE ID) to the matrices defining it, in the order of
+    the Matrices
+    '''
+    definitions = collections.defaultdict(list)
+    for matrix in Matrices:
+        if matrix in fingerprints:
+            for modified, type, mitreid, revoked in fingerprints[matrix]['objects'].values():
+                key = (type, cacheKey(mitreid))
+                if not definitions[key] or definitions[key][-1] != matrix:
+                    definitions[key].append(matrix)
+    return definitions
+
+
+def relationshipPairs(fingerprints):
+    '''
+    Return the set of all relationships in the fingerprints, as (category,
+    MITRE ID, category, MITRE ID) tuples, or None if a relationship refers to
+    an unknown object
+    '''
+    uids = {}
+    for matrix in fingerprints:
+        for uid, (modified, type, mitreid, revoked) in fingerprints[matrix]['objects'].items():
+            uids[uid] = (type, cacheKey(mitreid))
+    pairs = set()
+    for matrix in fingerprints:
+        for modified, sourceuid, targetuid in fingerprints[matrix]['relationships'].values():
+            if sourceuid not in uids or targetuid not in uids:
+                return None
+            # Relationships are stored in both directions, so their direction is irrelevant
+            pairs.add(min(uids[sourceuid], uids[targetuid]) + max(uids[sourceuid], uids[targetuid]))
+    return pairs
+
+
+def entityRecord(cache, category, mitreid):
+    '''
+    The canonical record of an entity that snapshots store and hash: its
+    metadata, whether it has been revoked or deprecated, the IDs of its
+    matrices and the IDs of the entities it is related to, per category
+    '''
+    entity = cache.entity(category, mitreid)
+    relationships = collections.defaultdict(list)
+    for neighbour in entity.edges:
+        relationships[cache.category(neighbour)].append(cache.mitreid(neighbour))
+    return {
+        'category': category,
+        'mitreid': mitreid,
+        'name': list(entity.name),
+        'description': list(entity.description),
+        'url': list(entity.url),
+        'revoked': entity.revoked,
+        'deprecated': entity.deprecated,
+        'matrices': sorted(cache.mitreid(matrix) for matrix in entity.matrices),
+        'relationships': {related: sorted(relationships[related]) for related in sorted(relationships)},
+    }
+
+
+def contentHash(data):
+    import hashlib
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def saveSnapshot(options, cache):
+    '''
+    Store a content-addressed snapshot of the cache in cachedir/snapshots.
+    Every entity record (see entityRecord) is stored once under its hash in
+    snapshots/objects, so a snapshot only adds the entities that changed.
+    The manifest of a snapshot lists the hash of every entity and of every
+    category, and is named after the hash of the category hashes: saving a
+    cache with the same content as an earlier one reuses its manifest. Every
+    save that changes the content is appended to snapshots/history.jsonl (see
+    listSnapshots), also when the manifest is reused. Returns the ID of the
+    snapshot.
+    '''
+    directory = pathlib.Path(options.cachedir) / 'snapshots'
+    manifest = {'categories': {}}
+    for category in categories:
+        hashes = {}
+        for mitreid in cache.ids[category]:
+            record = entityRecord(cache, category, mitreid)
+            hashes[mitreid] = contentHash(record)
+            objectfile = directory / 'objects' / hashes[mitreid][:2] / (hashes[mitreid] + '.json')
+            if not objectfile.exists():
+                objectfile.parent.mkdir(parents=True, exist_ok=True)
+                tempfile = objectfile.with_name(objectfile.name + '.tmp')
+                with open(tempfile, 'w') as f:
+                    json.dump(record, f)
+                os.replace(tempfile, objectfile)
+        manifest['categories'][category] = {'hash': contentHash(hashes), 'entities': hashes}
+    snapshotid = contentHash({category: manifest['categories'][category]['hash'] for category in categories})[:16]
+    history = listSnapshots(options)
+    entry = {
+        'id': snapshotid,
+        'sequence': history[-1]['sequence'] + 1 if history else 0,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'entities': sum(len(manifest['categories'][category]['entities']) for category in categories),
+    }
+    manifestfile = directory / (snapshotid + '.json')
+    if not manifestfile.exists():
+        manifest.update(entry)
+        tempfile = manifestfile.with_name(manifestfile.name + '.tmp')
+        with open(tempfile, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tempfile, manifestfile)
+        if options.verbose:
+            logging.info('Saved snapshot ' + snapshotid)
+    if not history or history[-1]['id'] != snapshotid:
+        directory.mkdir(parents=True, exist_ok=True)
+        with open(directory / 'history.jsonl', 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    return snapshotid
+
+
+def listSnapshots(options):
+    '''
+    Return the ID, sequence number, creation time and number of entities of
+    every saved snapshot, oldest first, from snapshots/history.jsonl. A
+    snapshot appears once for every time the cache returned to its content,
+    so 'latest' and 'previous' always follow the order of the saves. The
+    history of a snapshots directory written before it existed is rebuilt
+    from the manifests, once.
+    '''
+    directory = pathlib.Path(options.cachedir) / 'snapshots'
+    try:
+        with open(directory / 'history.jsonl', 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        pass
+    snapshots = []
+    for manifestfile in directory.glob('*.json'):
+        with open(manifestfile, 'r') as f:
+            manifest = json.load(f)
+        snapshots.append({key: manifest[key] for key in ('id', 'sequence', 'created', 'entities')})
+    snapshots.sort(key=lambda snapshot: snapshot['sequence'])
+    if snapshots:
+        tempfile = directory / 'history.jsonl.tmp'
+        with open(tempfile, 'w') as f:
+            f.writelines(json.dumps(snapshot) + '\n' for snapshot in snapshots)
+        os.replace(tempfile, directory / 'history.jsonl')
+    return snapshots
+
+
+def loadSnapshot(options, reference, snapshots=None):
+    '''
+    Load the manifest of the snapshot with the given ID or unique prefix of
+    one, or 'latest' or 'previous'. Only the manifest of that snapshot is read.
+    '''
+    snapshots = snapshots if snapshots is not None else listSnapshots(options)
+    if reference in ('latest', 'previous'):
+        position = -1 if reference == 'latest' else -2
+        matches = [snapshots[position]['id']] if len(snapshots) >= -position else []
+    else:
+        matches = sorted({snapshot['id'] for snapshot in snapshots if snapshot['id'].startswith(reference)})
+    if len(matches) != 1:
+        raise KeyError(reference)
+    with open(pathlib.Path(options.cachedir) / 'snapshots' / (matches[0] + '.json'), 'r') as f:
+        return json.load(f)
+
+
+def loadSnapshotObject(options, hash):
+    with open(pathlib.Path(options.cachedir) / 'snapshots' / 'objects' / hash[:2] / (hash + '.json'), 'r') as f:
+        return json.load(f)
+
+
+@metrics.timed('diff')
+def diffSnapshots(options, old='previous', new='latest'):
+    '''
+    Compare two snapshots. Categories with the same hash in both are skipped,
+    and only the records of the entities whose hashes differ are loaded, so
+    the time taken depends on the number of changes rather than on the size
+    of the snapshots.
+    '''
+    try:
+        snapshots = listSnapshots(options)
+        try:
+            oldmanifest = loadSnapshot(options, old, snapshots)
+            newmanifest = loadSnapshot(options, new, snapshots)
+        except KeyError as e:
+            response = {
+                'name': 'API Error',
+                'description': 'Unknown or ambiguous snapshot: ' + str(e.args[0]) + '! Choose from: ' +
+                               ', '.join(dict.fromkeys(snapshot['id'] for snapshot in snapshots)),
+            }
+            return
+        response = {
+            'old': oldmanifest['id'],
+            'new': newmanifest['id'],
+            'added': [],
+            'removed': [],
+            'revoked': [],
+            'deprecated': [],
+            'changed': {},
+        }
+        for category in categories:
+            oldcategory = oldmanifest['categories'].get(category, {'hash': None, 'entities': {}})
+            newcategory = newmanifest['categories'].get(category, {'hash': None, 'entities': {}})
+            if oldcategory['hash'] == newcategory['hash']:
+                continue
+            oldhashes = oldcategory['entities']
+            newhashes = newcategory['entities']
+            for mitreid in sorted(oldhashes.keys() - newhashes.keys()):
+                response['removed'].append(category + '/' + mitreid)
+            for mitreid in sorted(newhashes.keys() - oldhashes.keys()):
+                response['added'].append(category + '/' + mitreid)
+                record = loadSnapshotObject(options, newhashes[mitreid])
+                for flag in ('revoked', 'deprecated'):
+                    if record[flag]:
+                        response[flag].append(category + '/' + mitreid)
+            for mitreid in sorted(oldhashes.keys() & newhashes.keys()):
+                if oldhashes[mitreid] == newhashes[mitreid]:
+                    continue
+                oldrecord = loadSnapshotObject(options, oldhashes[mitreid])
+                newrecord = loadSnapshotObject(options, newhashes[mitreid])
+                changes = {}
+                for field in ('name', 'description', 'url', 'matrices'):
+                    if oldrecord[field] != newrecord[field]:
+                        changes[field] = {'old': oldrecord[field], 'new': newrecord[field]}
+                for flag in ('revoked', 'deprecated'):
+                    if newrecord[flag] and not oldrecord[flag]:
+                        response[flag].append(category + '/' + mitreid)
+                for related in sorted(set(oldrecord['relationships']) | set(newrecord['relationships'])):
+                    oldrelated = set(oldrecord['relationships'].get(related, []))
+                    newrelated = set(newrecord['relationships'].get(related, []))
+                    if oldrelated != newrelated:
+                        changes.setdefault('relationships', {})[related] = {
+                            'added': sorted(newrelated - oldrelated),
+                            'removed': sorted(oldrelated - newrelated),
+                        }
+                response['changed'][category + '/' + mitreid] = changes
+    except Exception as e:
+        response = {
+            'name': 'Python Error',
+            'description': str(type(e))+': '+str(e),
+        }
+    finally:
+        return response
+
+
+def DownloadMatrices(options, matrices=Matrices):
+    '''
+    Download all matrices concurrently. Returns True if any matrix file was
+    (re)written, False if they were all unchanged.
+    '''
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(matrices) or 1) as pool:
+        downloads = [pool.submit(downloadMatrix, options, matrices[matrix]) for matrix in matrices]
+        changed = [download.result() for download in downloads]
+    if not any(changed):
+        logging.info('None of the matrices have changed upstream')
+    return any(changed)
+
+
+def downloadMatrix(options, matrix, timeout=60):
+    '''
+    Download a single matrix into the cachedir. Unless forced, the ETag and
+    Last-Modified headers of the previous download (kept in a .meta file next
+    to the matrix) are sent along, so an unchanged matrix is not transferred
+    again. The download goes to a .part file that is renamed over the matrix
+    when complete, and an interrupted download (including one that stalls for
+    *timeout* seconds) is resumed from where it stopped on the next run.
+    Returns True if the matrix file was (re)written.
+    '''
+    import http.client
+    import shutil
+    import urllib.request
+    file, url = options.cachedir+'/'+matrix['file'], matrix['url']
+    jsonfile = pathlib.Path(file)
+    metafile = jsonfile.with_name(jsonfile.name + '.meta')
+    partfile = jsonfile.with_name(jsonfile.name + '.part')
+    if jsonfile.exists() and not (options.force or getattr(options, 'update', False)):
+        return False
+    try:
+        with open(metafile, 'r') as f:
+            meta = json.load(f)
+    except (ValueError, FileNotFoundError):
+        meta = {}
+    headers = {}
+    if not options.force:
+        if jsonfile.exists():
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last-modified'):
+                headers['If-Modified-Since'] = meta['last-modified']
+        partial = meta.get('partial', {})
+        validator = partial.get('etag') or partial.get('last-modified')
+        if partfile.exists() and validator:
+            headers['Range'] = 'bytes=%d-' % partfile.stat().st_size
+            headers['If-Range'] = validator
+    try:
+        logging.info('Downloading ' + url)
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+            validators = {
+                'etag': response.headers.get('ETag'),
+                'last-modified': response.headers.get('Last-Modified'),
+            }
+            # Remember which version the .part file belongs to, to be able to resume it
+            meta['partial'] = validators
+            with open(metafile, 'w') as f:
+                json.dump(meta, f)
+            with open(partfile, 'ab' if response.status == 206 else 'wb') as outfile:
+                shutil.copyfileobj(response, outfile)
+            if response.length:
+                # The connection was closed before the complete response was read
+                raise http.client.IncompleteRead(b'', response.length)
+        os.replace(partfile, jsonfile)
+        with open(metafile, 'w') as f:
+            json.dump(validators, f)
+        return True
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            logging.info('Matrix ' + url + ' has not changed')
+        elif e.code == 416:
+            logging.error('Download of ' + url + ' cannot be resumed, restarting it on the next run')
+            partfile.unlink()
+        else:
+            logging.error('Download of ' + url + ' failed: ' + str(e.reason))
+    except urllib.error.URLError as e:
+        logging.error('Download of ' + url + ' failed: ' + str(e.reason))
+    except (http.client.HTTPException, OSError) as e:
+        # The transfer was interrupted: keep the .part file to resume it
+        logging.error('Download of ' + url + ' was interrupted, resuming it on the next run: ' +
+                      str(type(e)) + ': ' + str(e))
+    return False
+
+
+def queryLines(options, lines, workers=None):
+    '''
+    Run the operations in lines (one JSON object per line, as accepted by
+    /api/batch) against the cache, which is loaded only once, and yield their
+    results as JSON lines in the order of the input. Unless workers is 1, the
+    operations are divided over a pool of forked processes that share the
+    loaded cache.
+    '''
+    import multiprocessing
+    store.warm = True
+    snapshot = store.get(options)
+    if snapshot is None:
+        logging.error('Cannot load the cachefile ' + str(options.cachefile))
+        return
+    snapshot.warm()
+    lines = ((index, line) for index, line in enumerate(lines) if line.strip())
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or not hasattr(os, 'fork'):
+        yield from (queryLine(options, line) for line in lines)
+        return
+    gc.collect()
+    gc.freeze()
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        yield from pool.imap(functools.partial(queryLine, options), lines, chunksize=64)
+
+
+def queryLine(options, line):
+    index, line = line
+    try:
+        operations = [json.loads(line)]
+        if not isinstance(operations[0], dict):
+            raise ValueError('not a JSON object')
+    except ValueError as e:
+        result, elapsed = {
+            'name': 'API Error',
+            'description': 'Invalid query on line ' + str(index + 1) + ': ' + str(e),
+        }, 0
+    else:
+        result, elapsed = next(runBatch(options, operations))
+    return json.dumps({'index': index, 'result': result, 'time': round(elapsed, 6)}) + '\n'
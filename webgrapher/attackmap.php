@@ -109,6 +109,31 @@ if ($q === "actoroverlap") {
     die();
   }
 }
+if ($q === "graph") {
+  if (isset($_GET['id'])) {
+    if (isset($_GET['target'])) {
+      $query = $api . '/graph/path?source=' . urlencode($_GET['id']) . '&target=' . urlencode($_GET['target']);
+    } else {
+      $query = $api . '/graph/neighborhood?entity=' . urlencode($_GET['id']);
+      if (isset($_GET['hops'])) {
+        $query .= '&hops=' . intval($_GET['hops']);
+      }
+      if (isset($_GET['limit'])) {
+        $query .= '&limit=' . intval($_GET['limit']);
+      }
+    }
+    if (isset($_GET['cat'])) {
+      foreach (explode(',', $_GET['cat']) as $cat) {
+        $query .= '&categories=' . urlencode($cat);
+      }
+    }
+  } else {
+    echo "<body>";
+    echo "<b>Incorrect usage! Specify an entity id!<b/>";
+    echo "</body></html>";
+    die();
+  }
+}
 if ($q === "search") {
   if (isset($_GET['params'])) {
     $params = $_GET['params'];
@@ -182,7 +207,27 @@ function emitGraph($parent=0, $key, $value) {
   }
 }
 
-if (isset($q)) {
+// The graph API already returns a list of nodes and edges
+function emitNodesEdges($obj) {
+  if (!isset($obj['nodes'])) {
+    return;
+  }
+  foreach ($obj['nodes'] as $node) {
+    $idsafe = json_encode($node['id']);
+    $labelsafe = json_encode($node['mitreid']);
+    $namesafe = json_encode($node['name']);
+    echo 'g.setNode(' . $idsafe . ', { label: ' . $labelsafe . ', description: ' . $namesafe . ', style: "fill: #aaffaa" });';
+    echo "\n";
+  }
+  foreach ($obj['edges'] as $edge) {
+    echo 'g.setEdge(' . json_encode($edge['source']) . ', ' . json_encode($edge['target']) . ', {});';
+    echo "\n";
+  }
+}
+
+if ($q === "graph") {
+  emitNodesEdges($obj);
+} elseif (isset($q)) {
   foreach ($obj as $key => $value) {
     emitGraph(0, $key, $value);
   }